@@ -0,0 +1,262 @@
+# Benchmarks for the thread-to-video pipeline.
+#
+# We generate synthetic threads of configurable size, swap Google's
+# text-to-speech (and, optionally, the browser) for local stand-ins, and
+# trace each stage as well as the whole of manufacture_video. Every case runs
+# in a fresh process so that peak memory is measured per case. Results are
+# printed as json lines so that runs can be compared.
+#
+# Run from the repository root, e.g.:
+#   python -m benchmarks.thread_to_video --sizes 10 100 1000 --output results.jsonl
+import argparse
+import contextlib
+import json
+import multiprocessing
+import os
+import random
+import resource
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+from PIL import Image
+
+from src.OfflineTTSBackend import OfflineTTSBackend
+from src.OutputProfile import presets
+from src.RedditSnapshot import RedditSnapshot
+from src.RedditThreadMediaFactory import RedditThreadMediaFactory
+from src.Tracer import Tracer
+from src.TTSClient import TTSClient
+
+# These words make up our synthetic comments, punctuation included,
+# so that text_cuts has something realistic to cut.
+words = (
+    "the of and to a in is it you that he was for on are with as I his they be at one have this from or had by "
+    "but what some we can out other were all there when up use your how said an each she which do their time if "
+    "will way about many then them would write like so these her long make thing see him two has look more day "
+    "could go come did my sound no most number who over know water than call first people may down side been now "
+    "find any new work part take get place made live where after back little only round man year came show every "
+    "good me give our under name very through just form much great think say help low line before turn cause same "
+    "mean differ move right boy old too does tell sentence set three want air well also play small end put home "
+    "e.g. 3.5 U.S. https://example.com ..."
+).split()
+punctuation = [".", ",", "?", "!", ":", "", "", "", "", ""]
+
+
+def synthetic_text(rng: random.Random, chars: int) -> str:
+    text = []
+    length = 0
+    while length < chars:
+        word = rng.choice(words) + rng.choice(punctuation)
+        text.append(word)
+        length += len(word) + 1
+    return " ".join(text)
+
+
+def synthetic_snapshot(ncomments: int, comment_chars: int, seed: int = 0) -> RedditSnapshot:
+    # Build a comment tree where each comment replies to the submission
+    # or to an earlier comment, with comment lengths spread around the mean.
+    rng = random.Random(seed)
+    comments = []
+    every = []
+    for i in range(ncomments):
+        comment = {
+            "id": f"c{i}",
+            "body": synthetic_text(rng, max(1, int(rng.expovariate(1 / comment_chars)))),
+            "score": rng.randint(-10, 5000),
+            "author": {"name": f"user{rng.randint(0, ncomments)}"},
+            "depth": 0,
+            "replies": []
+        }
+        if every and rng.random() < 0.5:
+            parent = rng.choice(every)
+            comment["depth"] = parent["depth"] + 1
+            parent["replies"].append(comment)
+        else:
+            comments.append(comment)
+        every.append(comment)
+
+    return RedditSnapshot({
+        "version": RedditSnapshot.version,
+        "submission": {
+            "id": f"bench{ncomments}",
+            "title": synthetic_text(rng, 120),
+            "score": 12345,
+            "author": {"name": "op"},
+            "subreddit": {"display_name": "AskReddit", "icon_img": "https://example.com/icon.png"},
+            "comments": comments
+        }
+    })
+
+
+class _FakeAssetCache:
+    # There is nothing to download when nothing is rendered.
+    def data_uri(self, url: str) -> str:
+        return url
+
+
+class _FakeRenderPool:
+    # Stands in for the browser with flat cards whose height grows with
+    # the length of the html, which is roughly what real renders do.
+    def __init__(self):
+        self.renders = 0
+
+    def _card(self, html_str: str) -> Image.Image:
+        self.renders += 1
+        return Image.new("RGBA", (1112, min(1400, 120 + len(html_str) // 40)), (26, 26, 27, 255))
+
+    def screenshot(self, html_str: str) -> Image.Image:
+        return self._card(html_str)
+
+    def screenshot_batch(self, html_strs: list[str]) -> list[Image.Image]:
+        return [self._card(html_str) for html_str in html_strs]
+
+
+def _directory_size(directory: str) -> int:
+    size = 0
+    for root, _, files in os.walk(directory):
+        for file in files:
+            with contextlib.suppress(FileNotFoundError):
+                size += os.path.getsize(os.path.join(root, file))
+    return size
+
+
+def run_case(ncomments: int, options: dict) -> dict:
+    # Every factory creates its temporary directory in here,
+    # so we can keep an eye on how much disk the pipeline uses.
+    scratch = tempfile.mkdtemp(prefix="RedditChronology.bench.")
+    tempfile.tempdir = scratch
+
+    peak_tmp_bytes = 0
+    sampling = threading.Event()
+
+    def sample():
+        nonlocal peak_tmp_bytes
+        while not sampling.wait(0.1):
+            peak_tmp_bytes = max(peak_tmp_bytes, _directory_size(scratch))
+
+    start = time.perf_counter()
+    snapshot = synthetic_snapshot(ncomments, options["comment_chars"], options["seed"])
+    snapshot_seconds = time.perf_counter() - start
+
+    kwargs = dict(
+        workers=options["workers"],
+        speech=options["speech"],
+        reveal=options["reveal"],
+        frames=options["frames"],
+        streaming=options["streaming"],
+        encoding=options["encoding"],
+        profiles=[presets[name] for name in options["profiles"]],
+        tts_client=TTSClient(
+            backend=OfflineTTSBackend(latency=options["tts_latency"]),
+            max_in_flight=options["tts_in_flight"]
+        )
+    )
+    if options["fake_renderer"]:
+        kwargs.update(render_pool=_FakeRenderPool(), asset_cache=_FakeAssetCache())
+
+    factory = RedditThreadMediaFactory(snapshot.submission, **kwargs)
+    # Replies are comments too, so every case reads all ncomments of them,
+    # not just the top-level ones.
+    comments = snapshot.submission.comments.list()
+    video_file = os.path.join(scratch, "bench.mp4")
+
+    tracer = Tracer()
+    sampler = threading.Thread(target=sample, daemon=True)
+    sampler.start()
+    with tracer:
+        start = time.perf_counter()
+        video_files = factory.manufacture_videos(factory.video_files(video_file), comments=comments)
+        total_seconds = time.perf_counter() - start
+    sampling.set()
+    sampler.join()
+
+    report = tracer.report()
+    if options["trace_dir"] is not None:
+        tracer.save_chrome_trace(os.path.join(options["trace_dir"], f"trace.{ncomments}.json"))
+
+    # ru_maxrss is in kilobytes on Linux but in bytes on macOS.
+    rss_unit = 1 if sys.platform == "darwin" else 1024
+    result = {
+        "comments": ncomments,
+        "characters": sum(len(comment.body) for comment in comments),
+        "options": options,
+        "snapshot_seconds": snapshot_seconds,
+        "total_seconds": total_seconds,
+        "comments_per_second": ncomments / total_seconds,
+        # Since stages run concurrently, their totals may add up
+        # to more than the end-to-end time.
+        "stages": report["stages"],
+        "counters": report["counters"],
+        "failures": len(factory.failures),
+        "video_bytes": {name: os.path.getsize(file) for name, file in video_files.items()},
+        "peak_rss_bytes": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * rss_unit,
+        "peak_children_rss_bytes": resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * rss_unit,
+        "peak_tmp_bytes": peak_tmp_bytes,
+    }
+
+    shutil.rmtree(scratch, ignore_errors=True)
+    return result
+
+
+def _run_case_in_child(ncomments: int, options: dict, results: multiprocessing.Queue):
+    results.put(run_case(ncomments, options))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the thread-to-video pipeline.")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10, 100, 1000], help="numbers of comments")
+    parser.add_argument("--comment-chars", type=int, default=200, help="mean comment length in characters")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--speech", choices=RedditThreadMediaFactory.speech_modes, default="cuts")
+    parser.add_argument("--reveal", choices=("render", "mask"), default="render")
+    parser.add_argument("--frames", choices=RedditThreadMediaFactory.frames_modes, default="png")
+    parser.add_argument("--streaming", action="store_true")
+    parser.add_argument("--profiles", nargs="+", choices=presets, default=["landscape"])
+    parser.add_argument("--encoding", choices=RedditThreadMediaFactory.encoding_modes, default="constant")
+    parser.add_argument("--tts-in-flight", type=int, default=8, help="text-to-speech requests in flight at once")
+    parser.add_argument("--tts-latency", type=float, default=0, help="seconds every text-to-speech request takes")
+    parser.add_argument("--fake-renderer", action="store_true", help="replace the browser with flat cards")
+    parser.add_argument("--trace-dir", help="save a chrome trace of every case to this directory")
+    parser.add_argument("--output", help="append json lines to this file rather than printing them")
+    args = parser.parse_args()
+    if args.fake_renderer and args.reveal == "mask":
+        parser.error("the fake renderer only supports --reveal render")
+
+    options = {
+        "comment_chars": args.comment_chars,
+        "seed": args.seed,
+        "workers": args.workers,
+        "speech": args.speech,
+        "reveal": args.reveal,
+        "frames": args.frames,
+        "streaming": args.streaming,
+        "encoding": args.encoding,
+        "profiles": args.profiles,
+        "tts_in_flight": args.tts_in_flight,
+        "tts_latency": args.tts_latency,
+        "fake_renderer": args.fake_renderer,
+        "trace_dir": args.trace_dir,
+    }
+
+    context = multiprocessing.get_context("spawn")
+    for ncomments in args.sizes:
+        results = context.Queue()
+        process = context.Process(target=_run_case_in_child, args=(ncomments, options, results))
+        process.start()
+        result = results.get()
+        process.join()
+
+        line = json.dumps(result)
+        if args.output is None:
+            print(line, flush=True)
+        else:
+            with open(args.output, "a") as f:
+                f.write(line + "\n")
+
+
+if __name__ == "__main__":
+    main()
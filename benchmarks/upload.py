@@ -0,0 +1,200 @@
+# Benchmarks for uploading videos.
+#
+# We run a local stand-in for YouTube's resumable upload endpoints, which
+# can be told to drop connections and fail requests at random, and upload
+# synthetic videos to it, several at once. Every upload is checked against
+# what the server received. Results are printed as json lines so that runs
+# can be compared.
+#
+# Run from the repository root, e.g.:
+#   python -m benchmarks.upload --size-mib 64 --uploads 4 --failure-rate 0.1
+import argparse
+import concurrent.futures
+import hashlib
+import http.server
+import itertools
+import json
+import os
+import random
+import re
+import socket
+import tempfile
+import threading
+import time
+import typing
+
+from src.Tracer import Tracer
+from src.YouTubeUploader import YouTubeUploader
+
+
+class _Session:
+    def __init__(self, size: int):
+        self.size = size
+        self.received = 0
+        self.sha256 = hashlib.sha256()
+        self.lock = threading.Lock()
+
+
+class StandInServer(http.server.ThreadingHTTPServer):
+    # A stand-in for the resumable upload protocol. failure_rate is the
+    # chance that any chunk fails, half of the time with a 503 and half
+    # of the time by dropping the connection halfway through the chunk.
+    daemon_threads = True
+
+    def __init__(self, failure_rate: float = 0, seed: int = 0):
+        super(StandInServer, self).__init__(("127.0.0.1", 0), _StandInHandler)
+        self.failure_rate = failure_rate
+        self.rng = random.Random(seed)
+        self.sessions = {}
+        self.ids = itertools.count()
+        self.lock = threading.Lock()
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self.server_address[1]}"
+
+    def fail(self) -> typing.Optional[str]:
+        with self.lock:
+            if self.rng.random() >= self.failure_rate:
+                return None
+            return self.rng.choice(("status", "drop"))
+
+
+class _StandInHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def _respond(self, status: int, headers: dict = None, body: bytes = b""):
+        self.send_response(status)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _progress(self, session_id: str, session: _Session):
+        if session.received == session.size:
+            self._respond(201, {"Content-Type": "application/json"}, json.dumps({"id": session_id}).encode())
+        elif session.received:
+            self._respond(308, {"Range": f"bytes=0-{session.received - 1}"})
+        else:
+            self._respond(308)
+
+    def do_POST(self):
+        # Start a session.
+        self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        with self.server.lock:
+            session_id = str(next(self.server.ids))
+            self.server.sessions[session_id] = _Session(int(self.headers["X-Upload-Content-Length"]))
+        self._respond(200, {"Location": f"{self.server.url}/sessions/{session_id}"})
+
+    def do_PUT(self):
+        session_id = self.path.rsplit("/", 1)[-1]
+        session = self.server.sessions.get(session_id)
+        length = int(self.headers.get("Content-Length", 0))
+        if session is None:
+            self.rfile.read(length)
+            self._respond(404)
+            return
+
+        with session.lock:
+            match = re.fullmatch(r"bytes (\d+)-(\d+)/\d+", self.headers.get("Content-Range", ""))
+            failure = self.server.fail() if match is not None else None
+            if failure == "drop":
+                self.rfile.read(length // 2)
+                self.close_connection = True
+                self.connection.shutdown(socket.SHUT_RDWR)
+                return
+
+            data = self.rfile.read(length)
+            if failure == "status":
+                self._respond(503)
+                return
+
+            # We only take bytes that pick up exactly where we left off.
+            if match is not None and int(match[1]) == session.received:
+                session.sha256.update(data)
+                session.received += len(data)
+            self._progress(session_id, session)
+
+
+def run(size: int, uploads: int, chunk_size: int, failure_rate: float, seed: int) -> dict:
+    server = StandInServer(failure_rate, seed)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    with tempfile.TemporaryDirectory() as directory:
+        files = []
+        rng = random.Random(seed)
+        for i in range(uploads):
+            file = os.path.join(directory, f"{i}.mp4")
+            with open(file, "wb") as f:
+                f.write(rng.randbytes(size))
+            with open(os.path.join(directory, f"{i}.jpg"), "wb") as f:
+                f.write(rng.randbytes(64 * 1024))
+            files.append(file)
+
+        def upload(file: str) -> dict:
+            uploader = YouTubeUploader(
+                file,
+                None,
+                None,
+                thumbnail=os.path.splitext(file)[0] + ".jpg",
+                title=os.path.basename(file),
+                description="",
+                category="24",
+                chunk_size=chunk_size,
+                video_endpoint=f"{server.url}/upload/videos",
+                thumbnail_endpoint=f"{server.url}/upload/thumbnails"
+            )
+            start = time.monotonic()
+            video_id = uploader.upload()
+            seconds = time.monotonic() - start
+
+            with open(file, "rb") as f:
+                expected = hashlib.sha256(f.read()).hexdigest()
+            if server.sessions[video_id].sha256.hexdigest() != expected:
+                raise RuntimeError(f"the server received a different {file}")
+            return {"seconds": seconds, "bytes_per_second": uploader.bytes_per_second}
+
+        tracer = Tracer()
+        with tracer, concurrent.futures.ThreadPoolExecutor(max_workers=uploads) as executor:
+            results = list(executor.map(upload, files))
+
+    server.shutdown()
+    server.server_close()
+    report = tracer.report()
+    return {
+        "size": size,
+        "uploads": uploads,
+        "chunk_size": chunk_size,
+        "failure_rate": failure_rate,
+        "seconds": report["wall_seconds"],
+        "bytes_per_second": uploads * size / report["wall_seconds"],
+        "per_upload": results,
+        "counters": report["counters"]
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark uploading videos to a local stand-in server.")
+    parser.add_argument("--size-mib", type=int, nargs="+", default=[16, 64])
+    parser.add_argument("--uploads", type=int, default=1, help="uploads at once")
+    parser.add_argument("--chunk-mib", type=int, default=8)
+    parser.add_argument("--failure-rate", type=float, default=0)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="also append the results to this file")
+    args = parser.parse_args()
+
+    for size_mib in args.size_mib:
+        result = run(size_mib << 20, args.uploads, args.chunk_mib << 20, args.failure_rate, args.seed)
+        line = json.dumps(result)
+        print(line, flush=True)
+        if args.output is not None:
+            with open(args.output, "a") as f:
+                print(line, file=f)
+
+
+if __name__ == "__main__":
+    main()
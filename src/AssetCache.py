@@ -0,0 +1,95 @@
+import base64
+import contextlib
+import hashlib
+import mimetypes
+import os
+import tempfile
+import threading
+import urllib.request
+import warnings
+
+
+class AssetCache:
+    # A persistent cache of remote assets (e.g., avatars, subreddit icons,
+    # and fonts) that hands them back as data uris to inline into html.
+    # Each distinct url is downloaded once, ever, so renders do not wait
+    # on the network and keep working without it.
+    _shared = None
+    _shared_lock = threading.Lock()
+
+    default_directory = os.path.join(
+        os.environ.get("XDG_CACHE_HOME", os.path.join(os.path.expanduser("~"), ".cache")),
+        "RedditChronology",
+        "assets"
+    )
+
+    def __init__(self, directory: str = None, timeout: float = 30):
+        self.directory = directory if directory is not None else self.default_directory
+        self.timeout = timeout
+
+        # We also keep the data uris in memory, since
+        # the same few assets show up over and over.
+        self._uris = {}
+        self._lock = threading.Lock()
+
+        os.makedirs(self.directory, exist_ok=True)
+
+    @classmethod
+    def shared(cls) -> "AssetCache":
+        with cls._shared_lock:
+            if cls._shared is None:
+                cls._shared = cls()
+            return cls._shared
+
+    def _path(self, url: str) -> str:
+        return os.path.join(self.directory, hashlib.sha256(url.encode()).hexdigest())
+
+    def _download(self, url: str, path: str):
+        with urllib.request.urlopen(url, timeout=self.timeout) as response:
+            content_type = response.headers.get_content_type()
+            data = response.read()
+
+        # Some servers do not bother with a useful content type.
+        if content_type in ("application/octet-stream", "text/plain"):
+            content_type = mimetypes.guess_type(url)[0] or content_type
+
+        # Write to a temporary file first and then atomically move it into
+        # place, so that concurrent readers never see a partial asset.
+        # The first line of the file is the content type.
+        fd, tmppath = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(content_type.encode() + b"\n" + data)
+            os.replace(tmppath, path)
+        except BaseException:
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(tmppath)
+            raise
+
+    def data_uri(self, url: str) -> str:
+        # Data uris are already inline, so there is nothing to do.
+        # Anything that is not an http(s) url (e.g., the empty icon_img
+        # of a subreddit without an icon) is left as it is, too.
+        if not url or not url.startswith(("http://", "https://")):
+            return url
+
+        with self._lock:
+            if url in self._uris:
+                return self._uris[url]
+
+        path = self._path(url)
+        if not os.path.exists(path):
+            try:
+                self._download(url, path)
+            except (OSError, ValueError) as e:
+                # We cannot inline the asset, so let the browser try instead.
+                warnings.warn(f"could not download {url}: {e!r}")
+                return url
+
+        with open(path, "rb") as f:
+            content_type, _, data = f.read().partition(b"\n")
+        uri = f"data:{content_type.decode()};base64,{base64.b64encode(data).decode()}"
+
+        with self._lock:
+            self._uris[url] = uri
+        return uri
@@ -0,0 +1,94 @@
+import typing
+
+from PIL import Image
+
+
+class OutputProfile:
+    # An output profile is the size of a video and where its cards go.
+    # Each card is scaled by card_scale, or, if card_scale is None, to fit
+    # the width of the frame. Cards never grow beyond the frame, less the
+    # margin on every side, and are always centered vertically.
+    # card_x is where the left edge of each card goes, or, if card_x is
+    # None, the cards are centered horizontally as well.
+    def __init__(
+            self,
+            name: str,
+            width: int,
+            height: int,
+            card_scale: typing.Optional[float] = 1.0,
+            card_x: typing.Optional[int] = 0,
+            margin: int = 0,
+            background: tuple[int, int, int] = (26, 26, 27)
+    ):
+        # libx264 with yuv420p needs even dimensions.
+        if width % 2 or height % 2:
+            raise ValueError(f"the size of {name} must be even, not {width}x{height}")
+
+        self.name = name
+        self.width = width
+        self.height = height
+        self.card_scale = card_scale
+        self.card_x = card_x
+        self.margin = margin
+        # (26, 26, 27) are the RGB values corresponding to
+        # hex color #1A1A1B, the comment background color.
+        self.background = background
+
+    def __repr__(self) -> str:
+        return f"OutputProfile({self.name!r}, {self.width}, {self.height})"
+
+    def key(self) -> list:
+        # Everything that affects how a video looks in this profile.
+        return [self.name, self.width, self.height, self.card_scale, self.card_x, self.margin, list(self.background)]
+
+    def geometry(self, card_size: tuple[int, int]) -> tuple[int, int, int, int]:
+        # Return the (width, height, x, y) of a card of the given size.
+        width, height = card_size
+        room_width, room_height = self.width - 2 * self.margin, self.height - 2 * self.margin
+        scale = room_width / width if self.card_scale is None else self.card_scale
+        scale = min(scale, room_width / width, room_height / height)
+
+        scaled_width, scaled_height = max(1, round(width * scale)), max(1, round(height * scale))
+        x = (self.width - scaled_width) // 2 if self.card_x is None else self.card_x
+        y = (self.height - scaled_height) // 2
+        return scaled_width, scaled_height, x, y
+
+    def composite(self, card: Image.Image, frame: Image.Image = None) -> Image.Image:
+        # Paste the card onto a blank frame. If given a frame of
+        # our size, we reuse it rather than allocating a new one.
+        if frame is None:
+            frame = Image.new("RGB", (self.width, self.height), self.background)
+        else:
+            frame.paste(self.background, (0, 0, self.width, self.height))
+
+        width, height, x, y = self.geometry(card.size)
+        if (width, height) != card.size:
+            card = card.resize((width, height), Image.LANCZOS)
+        frame.paste(card, (x, y))
+        return frame
+
+    def place(self, stream, card_size: tuple[int, int]):
+        # This does in ffmpeg what composite does in PIL,
+        # i.e., scale the card and pad it out to a whole frame.
+        width, height, x, y = self.geometry(card_size)
+        if (width, height) != tuple(card_size):
+            stream = stream.filter("scale", width, height, flags="lanczos")
+        return self._pad(stream, x, y)
+
+    def fit(self, stream):
+        # Fit a whole video (e.g., the transition) into the frame.
+        stream = stream.filter("scale", self.width, self.height, force_original_aspect_ratio="decrease")
+        return self._pad(stream, "(ow-iw)/2", "(oh-ih)/2")
+
+    def _pad(self, stream, x, y):
+        # Every branch must come out with the same size and aspect ratio
+        # for ffmpeg's concat filter to accept it.
+        color = "0x{:02X}{:02X}{:02X}".format(*self.background)
+        return stream.filter("pad", self.width, self.height, x, y, color=color).filter("setsar", 1)
+
+
+# These are the profiles we publish in.
+landscape = OutputProfile("landscape", 2560, 1440)
+landscape_1080p = OutputProfile("1080p", 1920, 1080, card_scale=0.75)
+vertical_short = OutputProfile("short", 1080, 1920, card_scale=None, card_x=None, margin=24)
+presets = {profile.name: profile for profile in (landscape, landscape_1080p, vertical_short)}
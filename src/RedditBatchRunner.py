@@ -0,0 +1,282 @@
+import concurrent.futures
+import os
+import threading
+import time
+import traceback
+import typing
+
+import praw
+
+from .AssetCache import AssetCache
+from .RedditSnapshot import RedditSnapshot
+from .RedditThreadMediaFactory import RedditThreadMediaFactory
+from .RedditThumbnailMediaFactory import RedditThumbnailMediaFactory
+from .RenderPool import RenderPool
+from .ResourceLimits import ResourceLimits
+from .Tracer import Tracer
+from .TTSCache import TTSCache
+from .TTSClient import TTSClient
+from .YouTubeUploader import YouTubeUploader
+
+
+class RedditJob:
+    # A job turns one submission into a video and a thumbnail,
+    # and then uploads them if the runner is set up to upload.
+    # Every stage is "pending", "running", "done", "failed", or "skipped".
+    stages = ("fetch", "video", "thumbnail", "upload")
+
+    def __init__(self, source: str):
+        # The source is a submission id, a submission url, or a snapshot file.
+        self.source = source
+        self.snapshot = None
+        self.video_file = None
+        # These are the videos in every output profile, by profile name.
+        self.video_files = {}
+        self.thumbnail_file = None
+        self.video_id = None
+        # While uploading, this holds the bytes uploaded, the size of
+        # the video, and the average bytes per second so far.
+        self.upload_progress = None
+        self.stage_states = dict.fromkeys(self.stages, "pending")
+        self.stage_seconds = {}
+        self.error = None
+        self.traceback = None
+        self.started = None
+        self.finished = None
+        self.done = threading.Event()
+        # The video and the thumbnail are manufactured at the same time.
+        # Whichever finishes last moves the job on to uploading.
+        self._remaining = 2
+        self._lock = threading.Lock()
+
+    @property
+    def id(self) -> typing.Optional[str]:
+        return None if self.snapshot is None else self.snapshot.submission.id
+
+    @property
+    def state(self) -> str:
+        if self.error is not None:
+            return "failed"
+        if self.done.is_set():
+            return "done"
+        for stage in self.stages:
+            if self.stage_states[stage] == "running":
+                return stage
+        return "pending"
+
+    def status(self) -> dict:
+        return {
+            "source": self.source,
+            "id": self.id,
+            "state": self.state,
+            "stages": dict(self.stage_states),
+            "stage_seconds": dict(self.stage_seconds),
+            "video_file": self.video_file,
+            "video_files": dict(self.video_files),
+            "thumbnail_file": self.thumbnail_file,
+            "video_id": self.video_id,
+            "upload_progress": self.upload_progress,
+            "error": None if self.error is None else repr(self.error),
+            "seconds": None if self.started is None else (self.finished or time.monotonic()) - self.started
+        }
+
+
+class RedditBatchRunner:
+    # The batch runner makes videos out of many submissions at once.
+    # The stages of every job run on one shared pool of worker threads,
+    # so one job may be encoding while another is still rendering.
+    # All jobs share one render pool, one asset cache, and, if given,
+    # one text-to-speech cache. How many threads may use each expensive
+    # resource at once is limited across all jobs:
+    #   browsers: the size of the shared render pool.
+    #   tts: text-to-speech requests in flight, all sent over one shared client.
+    #   ffmpeg: concurrent ffmpeg processes.
+    #   uploads: concurrent uploads.
+    def __init__(
+            self,
+            output_directory: str = ".",
+            reddit: praw.Reddit = None,
+            workers: int = 4,
+            browsers: int = 2,
+            tts: int = 8,
+            tts_rate: float = None,
+            ffmpeg: int = 2,
+            uploads: int = 1,
+            tts_cache: TTSCache = None,
+            workdir: str = None,
+            runtime: float = None,
+            factory_kwargs: dict = None,
+            uploader_kwargs: dict = None
+    ):
+        # reddit is only needed to fetch submissions by id or url.
+        # factory_kwargs are passed to every RedditThreadMediaFactory.
+        # uploader_kwargs are passed to every YouTubeUploader, and must
+        # include credentials, storage, and category. Without them,
+        # nothing is uploaded. Interrupted uploads resume from a session
+        # file next to the video the next time the same job runs.
+        # If given a workdir, every job resumes from its own directory in it.
+        # If given a tts_rate, text-to-speech requests are spaced out to
+        # stay under that many per second, e.g., to stay within quota.
+        self.output_directory = output_directory
+        self.reddit = reddit
+        self.tts_cache = tts_cache
+        self.workdir = workdir
+        self.runtime = runtime
+        self.factory_kwargs = factory_kwargs or {}
+        self.uploader_kwargs = uploader_kwargs
+        self.jobs = []
+
+        self.render_pool = RenderPool(size=browsers)
+        self.asset_cache = AssetCache.shared()
+        self.tts_client = TTSClient(max_in_flight=tts, requests_per_second=tts_rate)
+        ResourceLimits.configure(tts=tts, ffmpeg=ffmpeg, upload=uploads)
+
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=workers)
+        os.makedirs(self.output_directory, exist_ok=True)
+
+    def __enter__(self) -> "RedditBatchRunner":
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def submit(self, source: str) -> RedditJob:
+        job = RedditJob(source)
+        self.jobs.append(job)
+        self._executor.submit(self._run_stage, job, "fetch", self._fetch, self._manufacture)
+        return job
+
+    def run(self, sources: typing.Iterable[str], status_callback=None, status_interval: float = 10) -> list[RedditJob]:
+        # Run a job for every source and wait for all of them to finish.
+        # While waiting, status_callback, if given, is called with
+        # the status of every job every status_interval seconds.
+        jobs = [self.submit(source) for source in sources]
+        for job in jobs:
+            while not job.done.wait(status_interval):
+                if status_callback is not None:
+                    status_callback(self.status())
+        return jobs
+
+    def status(self) -> list[dict]:
+        return [job.status() for job in self.jobs]
+
+    def close(self):
+        # Stages hand their jobs on to the next stages on the pool,
+        # so the pool must stay open until every job is done.
+        for job in self.jobs:
+            job.done.wait()
+        self._executor.shutdown(wait=True)
+        self.render_pool.close()
+        self.tts_client.close()
+
+    def _run_stage(self, job: RedditJob, stage: str, function, then=None):
+        # Run one stage of a job, then hand the job on to its next stages.
+        # A failed stage fails the whole job, but no other job.
+        if job.error is not None:
+            job.stage_states[stage] = "skipped"
+            return
+        if job.started is None:
+            job.started = time.monotonic()
+
+        job.stage_states[stage] = "running"
+        start = time.monotonic()
+        try:
+            with Tracer.span(stage, "job", source=job.source):
+                function(job)
+        except Exception as e:
+            job.stage_states[stage] = "failed"
+            job.stage_seconds[stage] = time.monotonic() - start
+            job.error = e
+            job.traceback = traceback.format_exc()
+            self._finish(job)
+            return
+
+        job.stage_states[stage] = "done"
+        job.stage_seconds[stage] = time.monotonic() - start
+        # The job may have failed in another stage in the meantime.
+        if then is not None and job.error is None:
+            then(job)
+
+    def _finish(self, job: RedditJob):
+        if job.done.is_set():
+            return
+        for stage, state in job.stage_states.items():
+            if state == "pending":
+                job.stage_states[stage] = "skipped"
+        job.finished = time.monotonic()
+        job.done.set()
+
+    def _fetch(self, job: RedditJob):
+        # We take a snapshot of every submission up front, so that the
+        # video and the thumbnail never wait on reddit, and so that they
+        # show exactly the same scores.
+        if os.path.isfile(job.source):
+            job.snapshot = RedditSnapshot.load(job.source)
+            return
+        if self.reddit is None:
+            raise ValueError(f"{job.source!r} is not a snapshot file, and there is no reddit instance to fetch it")
+        if job.source.startswith(("http://", "https://")):
+            submission = self.reddit.submission(url=job.source)
+        else:
+            submission = self.reddit.submission(id=job.source)
+        job.snapshot = RedditSnapshot.fetch(submission)
+
+    def _manufacture(self, job: RedditJob):
+        self._executor.submit(self._run_stage, job, "video", self._manufacture_video, self._manufactured)
+        self._executor.submit(self._run_stage, job, "thumbnail", self._manufacture_thumbnail, self._manufactured)
+
+    def _manufactured(self, job: RedditJob):
+        with job._lock:
+            job._remaining -= 1
+            if job._remaining:
+                return
+
+        if self.uploader_kwargs is None:
+            job.stage_states["upload"] = "skipped"
+            self._finish(job)
+        else:
+            self._executor.submit(self._run_stage, job, "upload", self._upload, self._finish)
+
+    def _manufacture_video(self, job: RedditJob):
+        workdir = None if self.workdir is None else os.path.join(self.workdir, job.id)
+        factory = RedditThreadMediaFactory(
+            job.snapshot.submission,
+            render_pool=self.render_pool,
+            tts_cache=self.tts_cache,
+            workdir=workdir,
+            asset_cache=self.asset_cache,
+            tts_client=self.tts_client,
+            **self.factory_kwargs
+        )
+        # We upload the video of the first profile.
+        job.video_files = factory.manufacture_videos(
+            factory.video_files(os.path.join(self.output_directory, f"{job.id}.mp4")),
+            runtime=self.runtime
+        )
+        job.video_file = job.video_files[factory.profiles[0].name]
+
+    def _manufacture_thumbnail(self, job: RedditJob):
+        factory = RedditThumbnailMediaFactory(job.snapshot.submission, self.render_pool, self.asset_cache)
+        job.thumbnail_file = factory.manufacture_thumbnail(os.path.join(self.output_directory, f"{job.id}.jpg"))
+
+    def _upload(self, job: RedditJob):
+        kwargs = dict(self.uploader_kwargs)
+        credentials = kwargs.pop("credentials")
+        storage = kwargs.pop("storage")
+        submission = job.snapshot.submission
+        kwargs.setdefault("title", submission.title[:100])
+        kwargs.setdefault("description", f"r/{submission.subreddit.display_name}\nhttps://redd.it/{submission.id}")
+
+        def progress(uploaded: int, size: int, bytes_per_second: float):
+            job.upload_progress = {"bytes": uploaded, "size": size, "bytes_per_second": bytes_per_second}
+
+        with ResourceLimits.slot("upload"):
+            uploader = YouTubeUploader(
+                job.video_file,
+                credentials,
+                storage,
+                thumbnail=job.thumbnail_file,
+                progress=progress,
+                **kwargs
+            )
+            job.video_id = uploader.upload()
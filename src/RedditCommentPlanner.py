@@ -0,0 +1,131 @@
+import typing
+
+import praw.models
+
+from .utils import text_cuts
+
+
+class RedditCommentPlanner:
+    # These are the supported strategies for selecting comments.
+    #   "top": take the highest scoring comments that still fit.
+    #   "knapsack": take the set of comments with the highest total score
+    #               that fits, which packs the runtime more tightly.
+    strategies = ("top", "knapsack")
+
+    def __init__(
+            self,
+            submission: praw.models.Submission,
+            chars_per_second: float = 14.5,
+            cut_pause: float = 0.25,
+            transition_duration: float = 0
+    ):
+        # We estimate spoken durations without asking for any speech.
+        # chars_per_second is roughly how fast Google's standard voices read,
+        # and cut_pause is roughly how long each cut adds in pauses.
+        # transition_duration is how long the optional transition lasts.
+        self.submission = submission
+        self.chars_per_second = chars_per_second
+        self.cut_pause = cut_pause
+        self.transition_duration = transition_duration
+
+    def estimate_duration(self, text: str) -> float:
+        cuts = text_cuts(text)
+        return sum(map(len, cuts)) / self.chars_per_second + len(cuts) * self.cut_pause
+
+    def comments(self) -> typing.Iterator[tuple[praw.models.Comment, int]]:
+        # Walk the comment tree depth first, so that comments come out in
+        # the order they appear in the thread, along with their depth.
+        # We use our own stack rather than recursion, since threads can
+        # be both enormous and deeply nested.
+        stack = [(comment, 0) for comment in reversed(list(self.submission.comments))]
+        while stack:
+            comment, depth = stack.pop()
+            # There may be unexpanded "load more comments" links in the tree.
+            if isinstance(comment, praw.models.MoreComments):
+                continue
+            yield comment, depth
+            stack.extend((reply, depth + 1) for reply in reversed(list(comment.replies)))
+
+    def plan(
+            self,
+            runtime: float,
+            strategy: str = "top",
+            min_score: int = None,
+            max_depth: int = None,
+            min_chars: int = None,
+            max_chars: int = None,
+            resolution: float = 0.5
+    ) -> list[praw.models.Comment]:
+        if strategy not in self.strategies:
+            raise ValueError(f"strategy must be one of {self.strategies}, not {strategy!r}")
+
+        # The title is always in the video, so it comes out of our budget first.
+        # Every comment then costs its own duration plus a transition.
+        budget = runtime - self.estimate_duration(self.submission.title) - self.transition_duration
+
+        # Let's gather the candidates that pass all our filters.
+        # A deleted or removed comment is not worth reading out loud.
+        candidates = []
+        for order, (comment, depth) in enumerate(self.comments()):
+            body = comment.body
+            if body in ("[deleted]", "[removed]"):
+                continue
+            if min_score is not None and comment.score < min_score:
+                continue
+            if max_depth is not None and depth > max_depth:
+                continue
+            if min_chars is not None and len(body) < min_chars:
+                continue
+            if max_chars is not None and len(body) > max_chars:
+                continue
+            duration = self.estimate_duration(body) + self.transition_duration
+            candidates.append((order, comment, duration))
+
+        if strategy == "knapsack":
+            selected = self._knapsack(candidates, budget, resolution)
+        else:
+            selected = self._top(candidates, budget)
+
+        # The video reads the selected comments in thread order.
+        return [comment for _, comment, _ in sorted(selected, key=lambda candidate: candidate[0])]
+
+    @staticmethod
+    def _top(candidates: list, budget: float) -> list:
+        selected = []
+        for candidate in sorted(candidates, key=lambda candidate: candidate[1].score, reverse=True):
+            if candidate[2] <= budget:
+                selected.append(candidate)
+                budget -= candidate[2]
+        return selected
+
+    @staticmethod
+    def _knapsack(candidates: list, budget: float, resolution: float) -> list:
+        # This is the classic 0/1 knapsack over durations rounded up to the
+        # resolution, where the value of a comment is its score.
+        # Comments with no positive score can only lower the total.
+        candidates = [candidate for candidate in candidates if candidate[1].score > 0]
+        capacity = int(budget // resolution)
+        if capacity <= 0:
+            return []
+
+        # best[c] is the highest total score that fits in c units of time.
+        # taken[i][c] records whether candidate i was taken to reach best[c],
+        # which lets us walk back through our choices afterwards.
+        best = [0] * (capacity + 1)
+        taken = []
+        for _, comment, duration in candidates:
+            weight = max(1, -int(-duration // resolution))
+            took = bytearray(capacity + 1)
+            for c in range(capacity, weight - 1, -1):
+                if best[c - weight] + comment.score > best[c]:
+                    best[c] = best[c - weight] + comment.score
+                    took[c] = 1
+            taken.append(took)
+
+        selected = []
+        c = capacity
+        for i in range(len(candidates) - 1, -1, -1):
+            if taken[i][c]:
+                selected.append(candidates[i])
+                c -= max(1, -int(-candidates[i][2] // resolution))
+        return selected
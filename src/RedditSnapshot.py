@@ -0,0 +1,193 @@
+import gzip
+import json
+
+import praw.models
+
+
+# These classes stand in for the praw models that the media factories read.
+# They hold plain data, so no attribute access ever touches the network.
+
+class _SnapshotRedditor:
+    def __init__(self, name: str, icon_img: str = None):
+        self.name = name
+        # Like praw, we leave icon_img out entirely when the redditor
+        # does not have one (e.g., suspended accounts), so that getattr
+        # falls back to a default avatar.
+        if icon_img is not None:
+            self.icon_img = icon_img
+
+
+class _SnapshotSubreddit:
+    def __init__(self, display_name: str, icon_img: str):
+        self.display_name = display_name
+        self.icon_img = icon_img
+
+
+class _SnapshotCommentForest(list):
+    # Every comment is already loaded, so there is never more to replace.
+    def replace_more(self, limit: int = 32, threshold: int = 0) -> list:
+        return []
+
+    def list(self) -> list:
+        # Flatten the forest breadth first, like praw does.
+        comments = []
+        queue = list(self)
+        while queue:
+            comment = queue.pop(0)
+            comments.append(comment)
+            queue.extend(comment.replies)
+        return comments
+
+
+class _SnapshotComment:
+    def __init__(self, id: str, body: str, score: int, author: _SnapshotRedditor, depth: int):
+        self.id = id
+        self.body = body
+        self.score = score
+        self.author = author
+        self.depth = depth
+        self.replies = _SnapshotCommentForest()
+
+
+class _SnapshotSubmission:
+    def __init__(
+            self,
+            id: str,
+            title: str,
+            score: int,
+            author: _SnapshotRedditor,
+            subreddit: _SnapshotSubreddit
+    ):
+        self.id = id
+        self.title = title
+        self.score = score
+        self.author = author
+        self.subreddit = subreddit
+        self.comments = _SnapshotCommentForest()
+
+
+class RedditSnapshot:
+    # A snapshot is a submission and its entire comment tree, along with
+    # every attribute that our media factories read, fetched in one go.
+    # Snapshots are saved as compact gzipped json. The factories can run
+    # from snapshot.submission exactly as they do from a praw submission,
+    # but without any network access. That also makes snapshots handy
+    # fixtures for rendering the same thread over and over.
+    version = 1
+
+    def __init__(self, data: dict):
+        self.data = data
+        self.submission = self._build_submission(data["submission"])
+
+    @classmethod
+    def fetch(cls, submission: praw.models.Submission, replace_more_limit: int = 0) -> "RedditSnapshot":
+        # First, load the whole comment tree up front.
+        # The default limit of 0 matches RedditThreadMediaFactory.
+        submission.comments.replace_more(limit=replace_more_limit)
+
+        # Then, walk the tree, gathering every comment and its author.
+        # Accessing author.icon_img on every comment would fetch each
+        # author one request at a time. Instead, we remember the authors'
+        # fullnames and look up all their icons in bulk afterwards.
+        authors = {}
+
+        def author_data(thing) -> dict:
+            if thing.author is None:
+                return None
+            data = {"name": thing.author.name}
+            fullname = getattr(thing, "author_fullname", None)
+            if fullname is not None:
+                authors.setdefault(fullname, []).append(data)
+            return data
+
+        def comment_data(comment: praw.models.Comment, depth: int) -> dict:
+            return {
+                "id": comment.id,
+                "body": comment.body,
+                "score": comment.score,
+                "author": author_data(comment),
+                "depth": depth,
+                "replies": []
+            }
+
+        # We use our own stack rather than recursion,
+        # since threads can be deeply nested.
+        comments = []
+        stack = [(comment, 0, comments) for comment in reversed(list(submission.comments))]
+        while stack:
+            comment, depth, siblings = stack.pop()
+            if isinstance(comment, praw.models.MoreComments):
+                continue
+            data = comment_data(comment, depth)
+            siblings.append(data)
+            stack.extend((reply, depth + 1, data["replies"]) for reply in reversed(list(comment.replies)))
+
+        # Reddit hands back up to 100 partial redditors per request,
+        # which include their profile pictures.
+        if authors:
+            reddit = submission._reddit
+            for redditor in reddit.redditors.partial_redditors(list(authors)):
+                for data in authors.get(redditor.fullname, []):
+                    data["icon_img"] = getattr(redditor, "profile_img", None)
+
+        data = {
+            "version": cls.version,
+            "submission": {
+                "id": submission.id,
+                "title": submission.title,
+                "score": submission.score,
+                "author": None if submission.author is None else {"name": submission.author.name},
+                "subreddit": {
+                    "display_name": submission.subreddit.display_name,
+                    "icon_img": submission.subreddit.icon_img
+                },
+                "comments": comments
+            }
+        }
+        return cls(data)
+
+    @classmethod
+    def load(cls, snapshot_file: str) -> "RedditSnapshot":
+        with gzip.open(snapshot_file, "rt", encoding="utf-8") as f:
+            data = json.load(f)
+        if data.get("version") != cls.version:
+            raise ValueError(f"unsupported snapshot version {data.get('version')!r}")
+        return cls(data)
+
+    def save(self, snapshot_file: str = None) -> str:
+        if snapshot_file is None:
+            snapshot_file = f"{self.submission.id}.json.gz"
+        with gzip.open(snapshot_file, "wt", encoding="utf-8") as f:
+            json.dump(self.data, f, separators=(",", ":"))
+        return snapshot_file
+
+    @staticmethod
+    def _build_redditor(data: dict) -> _SnapshotRedditor:
+        if data is None:
+            return None
+        return _SnapshotRedditor(data["name"], data.get("icon_img"))
+
+    @classmethod
+    def _build_submission(cls, data: dict) -> _SnapshotSubmission:
+        submission = _SnapshotSubmission(
+            data["id"],
+            data["title"],
+            data["score"],
+            cls._build_redditor(data["author"]),
+            _SnapshotSubreddit(data["subreddit"]["display_name"], data["subreddit"]["icon_img"])
+        )
+
+        stack = [(comment, submission.comments) for comment in reversed(data["comments"])]
+        while stack:
+            comment_data, siblings = stack.pop()
+            comment = _SnapshotComment(
+                comment_data["id"],
+                comment_data["body"],
+                comment_data["score"],
+                cls._build_redditor(comment_data["author"]),
+                comment_data["depth"]
+            )
+            siblings.append(comment)
+            stack.extend((reply, comment.replies) for reply in reversed(comment_data["replies"]))
+
+        return submission
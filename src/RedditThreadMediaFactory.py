@@ -1,20 +1,167 @@
+import collections
+import concurrent.futures
+import contextlib
+import hashlib
 import itertools
+import json
+import math
 import os
+import threading
+import typing
+import warnings
 
 import ffmpeg
+from PIL import Image
 import praw.models
 
+from .AssetCache import AssetCache
+from .html_formats import comment_html_format, title_html_format
+from .OutputProfile import OutputProfile, landscape
+from .RedditCommentPlanner import RedditCommentPlanner
 from ._RedditCommentMediaFactory import _RedditCommentMediaFactory
 from ._MediaFactory import _MediaFactory
 from ._RedditTitleMediaFactory import _RedditTitleMediaFactory
-from .utils import chunk, media_duration
+from .RenderPool import RenderPool
+from .ResourceLimits import ResourceLimits
+from .Tracer import Tracer
+from .TTSCache import TTSCache
+from .TTSClient import TTSClient
+from .utils import chunk, media_duration, media_durations
 
 
 class RedditThreadMediaFactory(_MediaFactory):
-    def __init__(self, submission: praw.models.Submission, fps: float = 25, transition: tuple[str, str] = None):
+    # These are the supported strategies for concatenating the streams.
+    #   "segmented": encode every chunk of segments exactly once into an
+    #                intermediate mp4, then join the intermediates by stream copy.
+    #   "incremental": re-encode the growing mp4 together with each new chunk.
+    assembly_modes = ("segmented", "incremental")
+
+    # These are the supported strategies for synthesizing speech.
+    #   "cuts": synthesize every text cut with its own request.
+    #   "marks": synthesize each title or comment with a single request
+    #            and time the cuts with the timepoints of ssml marks.
+    #            This requires the "segmented" assembly.
+    speech_modes = ("cuts", "marks")
+
+    # These are the supported ways of handing images to ffmpeg.
+    #   "png": composite each image and save it as a png file.
+    #   "raw": keep each image in memory, composite it into a reusable
+    #          frame buffer, and stream raw frames to ffmpeg over a pipe.
+    #          This requires the "segmented" assembly.
+    frames_modes = ("png", "raw")
+
+    # These are the supported ways of encoding the video.
+    #   "constant": encode at a constant frame rate of fps.
+    #   "still": encode at a variable frame rate, with each image shown
+    #            as still_fps frames per second at most, a keyframe at the
+    #            start of every segment, and x264 tuned for still images.
+    #            Since every segment is a single still image, this encodes
+    #            far fewer frames into a far smaller file.
+    #            This requires the "segmented" assembly.
+    encoding_modes = ("constant", "still")
+
+    # When encoding stills, every image is repeated this many times per
+    # second, so that players and YouTube never go long without a frame.
+    # Keyframes come at least every still_gop seconds.
+    still_fps = 1
+    still_gop = 10
+
+    # Speech is requested for at most this many units past the
+    # newest one being manufactured.
+    speech_lookahead = 16
+
+    def __init__(
+            self,
+            submission: praw.models.Submission,
+            fps: float = 25,
+            transition: tuple[str, str] = None,
+            assembly: str = "segmented",
+            render_pool: RenderPool = None,
+            workers: int = 1,
+            tts_cache: TTSCache = None,
+            speech: str = "cuts",
+            reveal: str = "render",
+            frames: str = "png",
+            streaming: bool = False,
+            stream_buffer: int = 2,
+            workdir: str = None,
+            asset_cache: AssetCache = None,
+            encoding: str = "constant",
+            profiles: list[OutputProfile] = None,
+            tts_client: TTSClient = None
+    ):
+        if assembly not in self.assembly_modes:
+            raise ValueError(f"assembly must be one of {self.assembly_modes}, not {assembly!r}")
+        if speech not in self.speech_modes:
+            raise ValueError(f"speech must be one of {self.speech_modes}, not {speech!r}")
+        if frames not in self.frames_modes:
+            raise ValueError(f"frames must be one of {self.frames_modes}, not {frames!r}")
+        if frames == "raw" and assembly != "segmented":
+            raise ValueError("raw frames require the segmented assembly")
+        if streaming and assembly != "segmented":
+            raise ValueError("streaming requires the segmented assembly")
+        if workdir is not None and assembly != "segmented":
+            raise ValueError("a workdir requires the segmented assembly")
+        if encoding not in self.encoding_modes:
+            raise ValueError(f"encoding must be one of {self.encoding_modes}, not {encoding!r}")
+        if encoding == "still" and assembly != "segmented":
+            raise ValueError("still encoding requires the segmented assembly")
+        if speech == "marks" and assembly != "segmented":
+            raise ValueError("speech marks require the segmented assembly")
+        profiles = [landscape] if profiles is None else list(profiles)
+        if not profiles or len({profile.name for profile in profiles}) != len(profiles):
+            raise ValueError("profiles must be a nonempty list of profiles with distinct names")
+        if len(profiles) > 1 and (frames == "raw" or assembly != "segmented"):
+            raise ValueError("multiple profiles require png frames and the segmented assembly")
+
         self.submission = submission
         self.fps = fps
         self.transition = transition
+        self.assembly = assembly
+        # The title and comment factories all render with the same pool.
+        self.render_pool = render_pool
+        # They also share the cache of inlined avatars, icons, and fonts.
+        self.asset_cache = asset_cache
+        # Synthesized speech is looked up in and saved to this cache, if given.
+        self.tts_cache = tts_cache
+        # Speech is synthesized by this client, or, if None, the shared one.
+        self.tts_client = tts_client
+        self.speech = speech
+        # This is how the title and comment factories produce the images
+        # that reveal text, i.e., "render" or "mask".
+        self.reveal = reveal
+        self.frames = frames
+        self.encoding = encoding
+        # We manufacture one video for every output profile. The images and
+        # audio are manufactured once, and every chunk is encoded into all
+        # profiles at once by a single ffmpeg process.
+        self.profiles = profiles
+        # This is how many title and comment factories we manufacture at once.
+        self.workers = workers
+        # When streaming, chunks are encoded while the rest of the thread is
+        # still being manufactured, and intermediate files are deleted as soon
+        # as they are encoded. stream_buffer is how many chunks may wait
+        # for the encoder before manufacturing is held back.
+        self.streaming = streaming
+        self.stream_buffer = stream_buffer
+        # If given a workdir, we keep every unit's (i.e., the title's or a
+        # comment's) images, audio, and encoded video there, and we record
+        # them in a manifest. Later runs reuse whatever is already done.
+        # In this mode, each unit is encoded on its own by the workers.
+        # The path is made absolute, since the manifest and ffmpeg's concat
+        # lists (which resolve relative paths against their own directory)
+        # must find the files no matter where they are read from.
+        self.workdir = None if workdir is None else os.path.abspath(workdir)
+        self.manifest = {}
+        self._manifest_lock = threading.Lock()
+        if self.workdir is not None:
+            os.makedirs(self.workdir, exist_ok=True)
+            with contextlib.suppress(FileNotFoundError):
+                with open(self._manifest_file()) as f:
+                    self.manifest = json.load(f)
+        # This maps the ids of comments that failed to manufacture
+        # during the last call to manufacture_video to their errors.
+        self.failures = {}
 
         # By default, praw does not load all comments at once.
         # However, we want to fetch all the comments.
@@ -23,68 +170,89 @@ class RedditThreadMediaFactory(_MediaFactory):
 
         super(RedditThreadMediaFactory, self).__init__()
 
-    def manufacture_video(self, video_file: str = None, comments: list[praw.models.Comment] = None) -> str:
-        streams = []
-
-        # First, let's manufacture the title.
-        title_factory = _RedditTitleMediaFactory(self.submission)
-        title_image_files = title_factory.manufacture_images()
-        title_audio_files = title_factory.manufacture_audios()
-
-        # Then, create the ffmpeg input streams for the title.
-        # View comment below to understand how we calculate framemrate.
-        streams.extend(
-            itertools.chain.from_iterable(
-                (
-                    ffmpeg.input(image_file, framerate=1 / (mlen := media_duration(audio_file)), t=mlen),
-                    ffmpeg.input(audio_file)
-                )
-                for image_file, audio_file in zip(title_image_files, title_audio_files)
-            )
-        )
+    def manufacture_video(
+            self,
+            video_file: str = None,
+            comments: list[praw.models.Comment] = None,
+            runtime: float = None
+    ) -> str:
+        # Manufacture the video in every profile, and return the
+        # video of the first profile. See manufacture_videos.
+        video_files = None if video_file is None else self.video_files(video_file)
+        return self.manufacture_videos(video_files, comments, runtime)[self.profiles[0].name]
 
-        # Add optional transition.
-        if self.transition is not None:
-            streams.extend(
-                map(ffmpeg.input, self.transition)
-            )
+    def manufacture_videos(
+            self,
+            video_files: dict[str, str] = None,
+            comments: list[praw.models.Comment] = None,
+            runtime: float = None
+    ) -> dict[str, str]:
+        # video_files maps the names of profiles to where their videos go.
+        # By default, the first profile's video is named after the submission,
+        # and every other profile's video is named after the first.
+        video_files = {**self.video_files(f"{self.submission.id}.mp4"), **(video_files or {})}
+        with Tracer.span("manufacture_video", submission=self.submission.id):
+            return self._manufacture_videos(video_files, comments, runtime)
+
+    def video_files(self, video_file: str) -> dict[str, str]:
+        # These are the videos of every profile, named after video_file.
+        video_files = {self.profiles[0].name: video_file}
+        for profile in self.profiles[1:]:
+            video_files[profile.name] = self._profile_file(video_file, profile)
+        return video_files
+
+    @staticmethod
+    def _profile_file(file: str, profile: OutputProfile) -> str:
+        root, extension = os.path.splitext(file)
+        return f"{root}.{profile.name}{extension}"
+
+    def _manufacture_videos(
+            self,
+            video_files: dict[str, str],
+            comments: typing.Optional[list[praw.models.Comment]],
+            runtime: typing.Optional[float]
+    ) -> dict[str, str]:
+        # If we are given a target runtime rather than comments, let's plan
+        # which comments to use with their estimated spoken durations.
+        # This way, we only manufacture the comments that make the cut.
+        if comments is None and runtime is not None:
+            with Tracer.span("plan"):
+                comments = self.plan_comments(runtime)
 
-        # Let's create a comment media factory for each comment.
-        # We will use a random English (US) voice from Google's API.
+        # Let's create a media factory for the title and for each comment.
+        # Each uses a random, but consistent, English (US) voice from Google's API.
         if comments is None:
             comments = self.comments
-        comment_factories = [_RedditCommentMediaFactory(comment) for comment in comments]
-
-        # Welcome to the meat of our operation.
-        # We want to manufacture the image and audio files for each comment.
-        # Then, we will create the ffmpeg input streams for each comment.
-        for comment_factory in comment_factories:
-            comment_ifiles = comment_factory.manufacture_images()
-            comment_afiles = comment_factory.manufacture_audios()
-
-            # Since we are generating videos from singular images,
-            # we want the image to play for as long as its
-            # corresponding audio.
-            # Thus, we set the framerate to 1/(audio duration)
-            # and ffmpeg's t to the audio duration.
-            # We do nothing special to the audio.
-            streams.extend(
-                itertools.chain.from_iterable(
-                    (
-                        ffmpeg.input(ifile, framerate=1 / (mlen := media_duration(afile)), t=mlen),
-                        ffmpeg.input(afile),
-                    )
-                    for ifile, afile in zip(comment_ifiles, comment_afiles)
-                )
+        title_factory = _RedditTitleMediaFactory(
+            self.submission,
+            self.render_pool,
+            self.tts_cache,
+            self.reveal,
+            self._unit_directory(self.submission),
+            self.asset_cache,
+            self.tts_client
+        )
+        comment_factories = [
+            _RedditCommentMediaFactory(
+                comment,
+                self.render_pool,
+                self.tts_cache,
+                self.reveal,
+                self._unit_directory(comment),
+                self.asset_cache,
+                self.tts_client
             )
+            for comment in comments
+        ]
 
-            # Add optional transition.
-            if self.transition is not None:
-                streams.extend(
-                    map(ffmpeg.input, self.transition)
-                )
+        # Welcome to the meat of our operation.
+        # We want to manufacture the image and audio files for the title
+        # and each comment. The units come out of this generator in order
+        # as they are manufactured.
+        self.failures = {}
+        units = self._manufacture_units(title_factory, comment_factories)
 
-        # Now, let's concatenate the streams.
+        # Now, let's concatenate everything.
         tmpmp4 = os.path.join(self.tmpdir.name, "RedditThreadMediaFactory.tmp.{}.mp4")
         # The naive approach is to simply concatenate everything at once.
         # However, since it is likely we must concatenate hundreds or
@@ -92,6 +260,622 @@ class RedditThreadMediaFactory(_MediaFactory):
         # Mainstream operating systems limit how many file descriptors
         # can be opened at once. So, let's break up concatenation into chunks.
         # We will reasonably use chunks of size 32.
+        if self.workdir is not None:
+            # The units were already encoded by the workers.
+            tmpmp4 = self._assemble_cached(units, tmpmp4)
+        elif self.streaming:
+            # The units are encoded as they come out of manufacturing.
+            tmpmp4 = self._assemble_streaming(units, tmpmp4)
+        elif self.assembly == "segmented":
+            # The segments are encoded a chunk at a time, and chunks never
+            # straddle the transition, which is encoded just once.
+            tmpmp4 = self._assemble_chunked(list(units), tmpmp4)
+        else:
+            # Create the ffmpeg input streams for the title
+            # and each comment, each followed by the optional transition.
+            streams = []
+            for segments in units:
+                streams.extend(itertools.chain.from_iterable(map(self._segment_streams, segments)))
+
+                if self.transition is not None:
+                    streams.extend(self._transition_streams(self.profiles[0]))
+
+            tmpmp4 = self._assemble_incremental(streams, tmpmp4)
+
+        # Save the files to desired locations.
+        for profile in self.profiles:
+            os.rename(tmpmp4[profile.name], video_files[profile.name])
+
+        return {profile.name: video_files[profile.name] for profile in self.profiles}
+
+    def plan_comments(self, runtime: float, **kwargs) -> list[praw.models.Comment]:
+        # kwargs are passed to RedditCommentPlanner.plan.
+        transition_duration = 0 if self.transition is None else media_duration(self.transition[1])
+        planner = RedditCommentPlanner(self.submission, transition_duration=transition_duration)
+        return planner.plan(runtime, **kwargs)
+
+    def _manufacture_units(self, title_factory, comment_factories) -> typing.Iterator[list]:
+        # Rendering, text-to-speech, and probing all spend most of their time
+        # waiting on other processes or the network, so we manufacture up to
+        # self.workers factories at once on threads. Keep in mind that renders
+        # are also limited by the render pool size.
+        # We yield the segments of the title and then of each comment in
+        # thread order, so the final stream order does not depend on which
+        # factory happens to finish first. Only a bounded number of factories
+        # run ahead of the one we are waiting on, so a slow consumer of this
+        # generator holds back manufacturing rather than piling up files.
+        # With a workdir, a unit is the list of its encoded video files.
+        # Otherwise, a unit is the list of its segments.
+        # Speech only waits on Google, though, so we send the requests of
+        # the units up to self.speech_lookahead past the newest unit being
+        # manufactured, and the text-to-speech client keeps as many in flight
+        # as it may. That way, how long speech takes depends on how many
+        # requests may be in flight rather than on how many cuts there are,
+        # while the responses held in memory stay bounded.
+        units = [title_factory, *comment_factories]
+        prefetched = 0
+
+        def submit(executor, i, factory):
+            nonlocal prefetched
+            end = min(len(units), i + 1 + self.speech_lookahead)
+            for unit in units[prefetched:end]:
+                if self._needs_speech(unit):
+                    unit.prefetch_speech(self.speech == "marks")
+            prefetched = max(prefetched, end)
+            return factory, executor.submit(self._manufacture_unit, factory)
+
+        factories = enumerate(units)
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.workers) as executor:
+            pending = collections.deque(
+                submit(executor, i, factory)
+                for i, factory in itertools.islice(factories, 2 * self.workers)
+            )
+            while pending:
+                factory, future = pending.popleft()
+                for i, next_factory in itertools.islice(factories, 1):
+                    pending.append(submit(executor, i, next_factory))
+
+                # There is no video without a title.
+                if factory is title_factory:
+                    yield future.result()
+                    continue
+
+                # However, a single broken comment should not throw away the
+                # rest of the thread. We skip it and record what went wrong.
+                try:
+                    segments = future.result()
+                except Exception as e:
+                    self.failures[factory.comment.id] = e
+                    warnings.warn(f"skipping comment {factory.comment.id}: {e!r}")
+                    continue
+                yield segments
+
+    def _manufacture_unit(self, factory) -> list:
+        # Each unit gets its own span, so that the trace shows which
+        # title or comment took how long, and on which worker.
+        if hasattr(factory, "comment"):
+            span = Tracer.span("unit", "unit", comment=factory.comment.id)
+        else:
+            span = Tracer.span("unit", "unit", submission=factory.submission.id)
+        with span:
+            if self.workdir is not None:
+                return self._manufacture_cached(factory)
+            return self._manufacture_segments(factory)
+
+    def _manufacture_segments(self, factory) -> list[tuple[typing.Union[str, Image.Image], str, float, float]]:
+        # A segment is an image to display for the duration of its
+        # corresponding audio. The audio is the part of audio_file
+        # that starts at offset and lasts for duration.
+        # The image is a card, i.e., not yet composited onto a frame,
+        # either saved as a png file or, for raw frames, kept in memory.
+        with Tracer.span("images"):
+            if self.frames == "raw":
+                image_files = list(factory.manufacture_cards())
+            else:
+                image_files = factory.manufacture_card_files()
+
+        if self.speech == "marks":
+            # Every cut shares one audio file, so there are
+            # no gaps in the audio at the cut boundaries.
+            with Tracer.span("audio"):
+                audio_file, spans = factory.manufacture_marked_audio()
+            return [
+                (image_file, audio_file, offset, duration)
+                for image_file, (offset, duration) in zip(image_files, spans)
+            ]
+
+        with Tracer.span("audio"):
+            audio_files = factory.manufacture_audios()
+        return [
+            (image_file, audio_file, 0.0, duration)
+            for image_file, audio_file, duration in zip(image_files, audio_files, media_durations(audio_files))
+        ]
+
+    def _manifest_file(self) -> str:
+        return os.path.join(self.workdir, "manifest.json")
+
+    def _save_manifest(self):
+        # Write the manifest atomically, so that a crash
+        # can never leave a half-written manifest behind.
+        tmpfile = self._manifest_file() + ".tmp"
+        with open(tmpfile, "w") as f:
+            json.dump(self.manifest, f)
+        os.replace(tmpfile, self._manifest_file())
+
+    def _unit_key(self, thing) -> str:
+        # Everything that affects the images, the speech, or the encoding
+        # of the title or a comment goes into its key. If any of it
+        # changes (e.g., the score), the unit is manufactured again.
+        if hasattr(thing, "body"):
+            content = [
+                "comment",
+                thing.id,
+                thing.body,
+                thing.score,
+                getattr(thing.author, "name", "anonymous"),
+                comment_html_format
+            ]
+        else:
+            content = [
+                "title",
+                thing.id,
+                thing.title,
+                thing.score,
+                getattr(thing.author, "name", "anonymous"),
+                thing.subreddit.display_name,
+                thing.subreddit.icon_img,
+                title_html_format
+            ]
+        content.extend([self.reveal, self.speech, self.frames, self.fps, self.encoding])
+        content.extend(profile.key() for profile in self.profiles)
+        return hashlib.sha256(json.dumps(content).encode()).hexdigest()
+
+    def _unit_directory(self, thing) -> typing.Optional[str]:
+        if self.workdir is None:
+            return None
+        return os.path.join(self.workdir, "units", self._unit_key(thing))
+
+    def _cached_entry(self, factory) -> dict:
+        key = self._unit_key(getattr(factory, "comment", None) or factory.submission)
+        with self._manifest_lock:
+            return self.manifest.setdefault(key, {})
+
+    def _cached_videos(self, entry: dict) -> typing.Optional[list[str]]:
+        # The unit is done if all its encoded videos exist in every profile.
+        videos = entry.get("videos")
+        if videos and all(
+                os.path.exists(self._profile_file(video, profile))
+                for video in videos
+                for profile in self.profiles
+        ):
+            return videos
+        return None
+
+    @staticmethod
+    def _cached_segments(entry: dict) -> typing.Optional[list]:
+        # We may have gotten as far as manufacturing a unit's images and audio.
+        segments = entry.get("segments")
+        if segments and all(os.path.exists(file) for segment in segments for file in segment[:2]):
+            return segments
+        return None
+
+    def _needs_speech(self, factory) -> bool:
+        if self.workdir is None:
+            return True
+        entry = self._cached_entry(factory)
+        return self._cached_videos(entry) is None and self._cached_segments(entry) is None
+
+    def _manufacture_cached(self, factory) -> list[str]:
+        entry = self._cached_entry(factory)
+        videos = self._cached_videos(entry)
+        if videos is not None:
+            return videos
+
+        # Otherwise, we may be able to pick up from its images and audio.
+        # We cannot resume raw frames, which live in memory.
+        segments = self._cached_segments(entry)
+        if segments is None:
+            segments = self._manufacture_segments(factory)
+            if self.frames != "raw":
+                with self._manifest_lock:
+                    entry["segments"] = segments
+                    self._save_manifest()
+
+        # Encode the unit in chunks that stay within
+        # our file descriptor budget.
+        size = 32 if self.frames == "raw" else 16
+        videos = [
+            self._encode_chunk(segments_chunk, os.path.join(factory.tmpdir.name, f"video.{i}.mp4"))
+            for i, segments_chunk in enumerate(chunk(segments, size))
+        ]
+        with self._manifest_lock:
+            entry["videos"] = videos
+            self._save_manifest()
+
+        return videos
+
+    def _assemble_cached(self, units: typing.Iterable[list[str]], tmpmp4: str) -> dict[str, str]:
+        segment_files = []
+        transition_file = self._encode_transition(tmpmp4)
+        for videos in units:
+            segment_files.extend(videos)
+            if transition_file is not None:
+                segment_files.append(transition_file)
+
+        # The encoded units must stay in the workdir for later runs.
+        return self._join_segments(segment_files, tmpmp4, remove=False)
+
+    def _segment_streams(self, segment: tuple[str, str, float, float]) -> tuple:
+        # These are the streams of a segment in the first profile.
+        image_file = segment[0]
+        return (
+            self.profiles[0].place(self._segment_image(segment), self._card_size(image_file)),
+            self._segment_audio(segment)
+        )
+
+    def _transition_streams(self, profile: OutputProfile) -> tuple:
+        video_file, audio_file = self.transition
+        return profile.fit(ffmpeg.input(video_file).video), ffmpeg.input(audio_file)
+
+    @staticmethod
+    def _card_size(image_file: typing.Union[str, Image.Image]) -> tuple[int, int]:
+        # Opening a png only reads its header, not the whole image.
+        if isinstance(image_file, Image.Image):
+            return image_file.size
+        with Image.open(image_file) as image:
+            return image.size
+
+    def _segment_image(self, segment: tuple[str, str, float, float]):
+        # Since we are generating videos from singular images,
+        # we want the image to play for as long as its
+        # corresponding audio.
+        # Thus, we set the framerate to 1/(audio duration)
+        # and ffmpeg's t to the audio duration.
+        # When encoding stills, we instead loop the image so that it is
+        # repeated a whole number of times over exactly the same duration.
+        image_file, _, _, duration = segment
+        if self.encoding == "still":
+            nframes = max(1, math.ceil(duration * self.still_fps))
+            return ffmpeg.input(image_file, loop=1, framerate=nframes / duration, t=duration)
+        return ffmpeg.input(image_file, framerate=1 / duration, t=duration)
+
+    @staticmethod
+    def _segment_audio(segment: tuple[typing.Union[str, Image.Image], str, float, float]):
+        # Here, every cut has its own audio file, so we do nothing special
+        # to the audio. Cuts that share one audio file go through _chunk_audio.
+        return ffmpeg.input(segment[1])
+
+    def _chunk_audio(self, segments: list):
+        # Consecutive segments that share one audio file (i.e., the cuts of
+        # a title or comment with speech marks) follow each other in that
+        # file, so we open it once and trim out their whole span rather than
+        # opening and seeking it once for every cut.
+        # a=1 and v=0 concatenate only the audio.
+        if self.speech != "marks":
+            return ffmpeg.concat(*map(self._segment_audio, segments), v=0, a=1)
+
+        inputs = []
+        for audio_file, run in itertools.groupby(segments, key=lambda segment: segment[1]):
+            run = list(run)
+            offset = run[0][2]
+            end = run[-1][2] + run[-1][3]
+            inputs.append(ffmpeg.input(audio_file, ss=offset, t=end - offset))
+        return ffmpeg.concat(*inputs, v=0, a=1)
+
+    def _segment_output_kwargs(self, keyframes: list[float] = None) -> dict:
+        # We set the pixel format to yuv420p so that more
+        # media players (e.g., QuickTime) support our mp4.
+        # Every intermediate segment must share the exact same codecs
+        # and parameters so that they can later be joined by stream copy.
+        # Notably, the title, comments, and transition may all come with
+        # different audio sample rates, so we pin the audio format as well.
+        kwargs = dict(
+            pix_fmt="yuv420p",
+            vcodec="libx264",
+            acodec="aac",
+            ar=48000,
+            ac=2
+        )
+        if self.encoding != "still":
+            kwargs.update(r=self.fps)
+            return kwargs
+
+        # Stills keep the timestamps of their frames rather than being
+        # duplicated up to a constant frame rate (fps_mode needs ffmpeg 5.1).
+        # We pin the timescale too, since it would otherwise depend on
+        # the frame rates of the inputs.
+        # keyframes are the times at which segments start, if known.
+        # We force a keyframe just before each, which lands on the first
+        # frame of the segment since the frames before are much further off.
+        kwargs.update(
+            fps_mode="vfr",
+            video_track_timescale=90000,
+            tune="stillimage",
+            g=self.still_gop * self.still_fps
+        )
+        if keyframes:
+            kwargs.update(force_key_frames=",".join(f"{max(0.0, t - 0.001):.3f}" for t in keyframes))
+        return kwargs
+
+    def _keyframes(self, segments: list) -> list[float]:
+        # These are the times at which each segment starts. Raw frames
+        # are counted against the total elapsed time, just like _raw_timeline.
+        keyframes = []
+        elapsed = 0.0
+        for _, _, _, duration in segments:
+            keyframes.append(round(elapsed * self.fps) / self.fps if self.frames == "raw" else elapsed)
+            elapsed += duration
+        return keyframes
+
+    def _join_segments(self, segment_files: list[str], tmpmp4: str, remove: bool = True) -> dict[str, str]:
+        # Join the intermediate segments with ffmpeg's concat demuxer.
+        # The demuxer reads the segments one after another from a list file,
+        # so only one segment is open at a time, and c="copy" copies the
+        # packets without decoding or encoding anything.
+        # We join the segments of every profile into the profile's own video.
+        video_files = {}
+        for profile in self.profiles:
+            concat_file = os.path.join(self.tmpdir.name, f"RedditThreadMediaFactory.concat.{profile.name}.txt")
+            with open(concat_file, "w") as f:
+                for segment_file in segment_files:
+                    f.write("file '{}'\n".format(self._profile_file(segment_file, profile).replace("'", "'\\''")))
+
+            video_file = self._profile_file(tmpmp4.format("final"), profile)
+            self._run_ffmpeg(
+                "join",
+                ffmpeg.input(concat_file, format="concat", safe=0).output(video_file, c="copy"),
+                [video_file]
+            )
+            video_files[profile.name] = video_file
+
+            # The intermediate segments are no longer needed.
+            if remove:
+                for segment_file in set(segment_files):
+                    os.remove(self._profile_file(segment_file, profile))
+
+        return video_files
+
+    def _encode_transition(self, tmpmp4: str) -> typing.Optional[str]:
+        # The transition is the same every time,
+        # so we only need to encode it once.
+        if self.transition is None:
+            return None
+        transition_file = tmpmp4.format("transition")
+        video_file, audio_file = self.transition
+        videos = [
+            profile.fit(video)
+            for profile, video in zip(self.profiles, self._split(ffmpeg.input(video_file).video, "split"))
+        ]
+        self._encode_profiles(videos, ffmpeg.input(audio_file), transition_file)
+        return transition_file
+
+    def _split(self, stream, split: str = "split") -> list:
+        # Split a stream into one branch for every profile.
+        # Audio streams must be split with asplit instead.
+        if len(self.profiles) == 1:
+            return [stream]
+        branches = stream.filter_multi_output(split, len(self.profiles))
+        return [branches[i] for i in range(len(self.profiles))]
+
+    def _encode_profiles(self, videos: list, audio, segment_file: str, keyframes: list[float] = None):
+        # Encode a video stream for every profile, along with the same audio,
+        # into the profiles' segment files in a single ffmpeg process.
+        outputs = []
+        output_files = []
+        for profile, video, audio_branch in zip(self.profiles, videos, self._split(audio, "asplit")):
+            output_file = self._profile_file(segment_file, profile)
+            outputs.append(ffmpeg.output(video, audio_branch, output_file, **self._segment_output_kwargs(keyframes)))
+            output_files.append(output_file)
+        self._run_ffmpeg("encode", ffmpeg.merge_outputs(*outputs), output_files, overwrite_output=True)
+
+    @staticmethod
+    def _run_ffmpeg(stage: str, output: ffmpeg.nodes.OutputStream, output_files: list[str], **kwargs):
+        # Every ffmpeg invocation is counted and timed under its stage.
+        # How many may run at once is limited across the whole process.
+        # kwargs are passed to ffmpeg's run.
+        Tracer.count("ffmpeg invocations")
+        with ResourceLimits.slot("ffmpeg"), Tracer.span(stage, "ffmpeg", file=os.path.basename(output_files[0])):
+            output.run(**kwargs)
+        for output_file in output_files:
+            Tracer.count_file(output_file)
+
+    def _chunk_units(self, units: typing.Iterable[list]) -> typing.Iterator[typing.Optional[list]]:
+        # Group the segments of each unit (i.e., the title or a comment)
+        # into chunks that each stay within our file descriptor budget.
+        # A png segment has two inputs, while a raw segment has just one.
+        # None stands for the transition, which always ends the chunk before it.
+        size = 32 if self.frames == "raw" else 16
+        segments_chunk = []
+        for unit in units:
+            for segment in unit:
+                segments_chunk.append(segment)
+                if len(segments_chunk) == size:
+                    yield segments_chunk
+                    segments_chunk = []
+
+            if self.transition is not None:
+                if segments_chunk:
+                    yield segments_chunk
+                    segments_chunk = []
+                yield None
+
+        if segments_chunk:
+            yield segments_chunk
+
+    def _encode_chunk(self, segments: list, segment_file: str) -> str:
+        if self.frames == "raw":
+            return self._encode_raw(segments, segment_file)
+
+        # Every image is split into a branch for each profile, where it is
+        # scaled and padded into the profile's frame. Then, the branches of
+        # each profile are concatenated into the profile's video.
+        # a=0 and v=1 concatenate only the video, and vice versa.
+        branches = [self._split(self._segment_image(segment)) for segment in segments]
+        videos = [
+            ffmpeg.concat(
+                *(
+                    profile.place(segment_branches[i], self._card_size(segment[0]))
+                    for segment, segment_branches in zip(segments, branches)
+                ),
+                v=1,
+                a=0
+            )
+            for i, profile in enumerate(self.profiles)
+        ]
+        audio = self._chunk_audio(segments)
+        self._encode_profiles(videos, audio, segment_file, self._keyframes(segments))
+        return segment_file
+
+    def _assemble_chunked(self, units: list[list], tmpmp4: str) -> dict[str, str]:
+        segment_files = []
+        transition_file = self._encode_transition(tmpmp4)
+        for segments_chunk in self._chunk_units(units):
+            if segments_chunk is None:
+                segment_files.append(transition_file)
+            else:
+                segment_files.append(self._encode_chunk(segments_chunk, tmpmp4.format(len(segment_files))))
+
+        return self._join_segments(segment_files, tmpmp4)
+
+    def _assemble_streaming(self, units: typing.Iterable[list], tmpmp4: str) -> dict[str, str]:
+        segment_files = []
+        transition_file = self._encode_transition(tmpmp4)
+
+        # Count how many segments still need each intermediate file.
+        # With speech marks, several segments share one audio file.
+        # Once a file is no longer needed, we delete it right away,
+        # so the temporary directory does not grow with the whole thread.
+        uses = collections.Counter()
+
+        def counted(units):
+            for unit in units:
+                for segment in unit:
+                    uses.update(self._segment_files(segment))
+                yield unit
+
+        def encode(segments, segment_file):
+            self._encode_chunk(segments, segment_file)
+            for segment in segments:
+                for file in self._segment_files(segment):
+                    uses[file] -= 1
+                    if uses[file] == 0:
+                        os.remove(file)
+
+        # Encoding happens on its own thread while the units are still being
+        # manufactured. We only let a couple of chunks wait for the encoder,
+        # which holds back manufacturing if the encoder falls behind.
+        with concurrent.futures.ThreadPoolExecutor(max_workers=1) as encoder:
+            pending = collections.deque()
+            for segments_chunk in self._chunk_units(counted(units)):
+                if segments_chunk is None:
+                    segment_files.append(transition_file)
+                    continue
+
+                segment_file = tmpmp4.format(len(segment_files))
+                segment_files.append(segment_file)
+                pending.append(encoder.submit(encode, segments_chunk, segment_file))
+                while len(pending) > self.stream_buffer:
+                    pending.popleft().result()
+
+            while pending:
+                pending.popleft().result()
+
+        return self._join_segments(segment_files, tmpmp4)
+
+    @staticmethod
+    def _segment_files(segment: tuple) -> set[str]:
+        # These are the intermediate files that a segment reads.
+        image_file, audio_file, _, _ = segment
+        return {audio_file} if isinstance(image_file, Image.Image) else {image_file, audio_file}
+
+    def _encode_raw(self, segments: list[tuple[Image.Image, str, float, float]], segment_file: str) -> str:
+        # Raw frames are composited in the first and only profile.
+        profile = self.profiles[0]
+        output_file = self._profile_file(segment_file, profile)
+
+        Tracer.count("ffmpeg invocations")
+        with ResourceLimits.slot("ffmpeg"), Tracer.span("encode", "ffmpeg", file=os.path.basename(output_file)):
+            self._pipe_raw(segments, output_file, profile)
+        Tracer.count_file(output_file)
+
+        return segment_file
+
+    def _raw_timeline(self, segments: list) -> list[tuple[int, int, float, float]]:
+        # Plan which frames go through the pipe as (segment index, count,
+        # start time, step) runs. Every still is written once, or, when
+        # encoding stills, still_fps times per second. Times are counted
+        # against the total elapsed time so that rounding errors do not build
+        # up across segments. A last copy of the final still marks the end.
+        timeline = []
+        elapsed = 0.0
+        for i, (_, _, _, duration) in enumerate(segments):
+            start = round(elapsed * self.fps) / self.fps
+            elapsed += duration
+            end = round(elapsed * self.fps) / self.fps
+            count = max(1, math.ceil((end - start) * self.still_fps)) if self.encoding == "still" else 1
+            timeline.append((i, count, start, (end - start) / count))
+
+        i, count, start, step = timeline[-1]
+        last = end - 1 / self.fps
+        if last > start + (count - 1) * step + 1e-6:
+            timeline.append((i, 1, last, 0.0))
+        return timeline
+
+    @staticmethod
+    def _timeline_pts(timeline: list[tuple[int, int, float, float]]) -> str:
+        # An expression for setpts that gives frame N its time in the timeline.
+        first = sum(count for _, count, _, _ in timeline)
+        expr = "0"
+        for _, count, start, step in reversed(timeline):
+            first -= count
+            expr = f"if(lt(N,{first + count}),{start:.6f}+(N-{first})*{step:.6f},{expr})"
+        return f"({expr})/TB"
+
+    def _pipe_raw(
+            self,
+            segments: list[tuple[Image.Image, str, float, float]],
+            output_file: str,
+            profile: OutputProfile
+    ):
+        # The video comes to ffmpeg as raw rgb frames over stdin, while the
+        # audio is read from the files as usual. Every still goes through the
+        # pipe only as often as the timeline says, and setpts moves each frame
+        # to its time. Just like with png files, the output frame rate then
+        # repeats frames after they are converted, rather than us piping and
+        # converting every repeat.
+        # a=1 and v=0 concatenate only the audio.
+        timeline = self._raw_timeline(segments)
+        size = f"{profile.width}x{profile.height}"
+        video = (
+            ffmpeg.input("pipe:", format="rawvideo", pix_fmt="rgb24", s=size, framerate=self.fps)
+            .filter("setpts", self._timeline_pts(timeline))
+        )
+        audio = self._chunk_audio(segments)
+        process = (
+            ffmpeg.output(video, audio, output_file, **self._segment_output_kwargs(self._keyframes(segments)))
+            .overwrite_output()
+            .run_async(pipe_stdin=True)
+        )
+
+        # We composite every card into the same preallocated frame buffer.
+        background = Image.new("RGB", (profile.width, profile.height), profile.background)
+        composited = None
+        frame = None
+        try:
+            for i, count, _, _ in timeline:
+                if i != composited:
+                    frame = profile.composite(segments[i][0], background).tobytes()
+                    composited = i
+                for _ in range(count):
+                    process.stdin.write(frame)
+        finally:
+            process.stdin.close()
+            process.wait()
+
+        if process.returncode != 0:
+            raise ffmpeg.Error("ffmpeg", None, None)
+
+    def _assemble_incremental(self, streams: list, tmpmp4: str) -> dict[str, str]:
         # First, create the mp4 file with the first up to 32 streams.
         # v=1 sets one output video stream.
         # a=1 sets one output audio stream.
@@ -99,17 +883,22 @@ class RedditThreadMediaFactory(_MediaFactory):
         concatenator = ffmpeg.concat(*streams[0:32], a=1, v=1)
         # We set the pixel format to yuv420p so that more
         # media players (e.g., QuickTime) support our mp4.
-        concatenator.output(tmpmp4.format(i), r=self.fps, pix_fmt="yuv420p").run()
+        self._run_ffmpeg(
+            "encode",
+            concatenator.output(tmpmp4.format(i), r=self.fps, pix_fmt="yuv420p"),
+            [tmpmp4.format(i)]
+        )
         # We are done if the number of streams is less than or equal to 32.
         # Otherwise, concatenate the rest of the streams to the mp4 in chunks.
+        # Note that this re-encodes all previous footage for every chunk.
         for i, streams_chunk in enumerate(chunk(streams[32:], 32), start=1):
             mp4 = ffmpeg.input(tmpmp4.format(i - 1))
             concatenator = ffmpeg.concat(mp4.video, mp4.audio, *streams_chunk, v=1, a=1)
-            concatenator.output(tmpmp4.format(i), r=self.fps, pix_fmt="yuv420p").run()
-
-        # Save the file to desired location.
-        if video_file is None:
-            video_file = f"{self.submission.id}.mp4"
-        os.rename(tmpmp4.format(i), video_file)
+            self._run_ffmpeg(
+                "encode",
+                concatenator.output(tmpmp4.format(i), r=self.fps, pix_fmt="yuv420p"),
+                [tmpmp4.format(i)]
+            )
 
-        return video_file
+        # The streams are all in the first and only profile.
+        return {self.profiles[0].name: tmpmp4.format(i)}
@@ -1,19 +1,27 @@
 import html
-import os
 
-from PIL import Image
 import praw.models
 
+from .AssetCache import AssetCache
 from .html_formats import title_html_format
 from ._HTIMediaFactory import _HTIMediaFactory
+from .OutputProfile import OutputProfile, landscape
+from .RenderPool import RenderPool
 from .utils import format_score
 
 
 class RedditThumbnailMediaFactory(_HTIMediaFactory):
-    def __init__(self, submission: praw.models.Submission):
+    def __init__(
+            self,
+            submission: praw.models.Submission,
+            render_pool: RenderPool = None,
+            asset_cache: AssetCache = None,
+            profile: OutputProfile = landscape
+    ):
         self.submission = submission
+        self.profile = profile
 
-        super(RedditThumbnailMediaFactory, self).__init__()
+        super(RedditThumbnailMediaFactory, self).__init__(render_pool, asset_cache=asset_cache)
 
     def manufacture_thumbnail(self, image_file: str = None) -> str:
         cut = html.escape(self.submission.title)
@@ -21,18 +29,16 @@ class RedditThumbnailMediaFactory(_HTIMediaFactory):
         title_html = title_html_format.format(
             "flex",
             format_score(self.submission.score),
-            self.submission.subreddit.icon_img,
+            self.inline(self.submission.subreddit.icon_img),
             self.submission.subreddit.display_name,
             self.submission.author.name,
-            cut
+            cut,
+            vote_font=self.vote_font
         )
-        self.hti.screenshot(html_str=title_html, save_as="RedditThumbnailMediaFactory.tmphti.png")
-
-        thumbnail_image = Image.open(os.path.join(self.tmpdir.name, "RedditThumbnailMediaFactory.tmphti.png"))
+        thumbnail_image = self.screenshot(title_html)
         thumbnail_image = thumbnail_image.crop(thumbnail_image.getbbox())
 
-        background = Image.new("RGB", (2560, 1440), (26, 26, 27))
-        background.paste(thumbnail_image, (0, (background.height - thumbnail_image.height) // 2))
+        background = self.profile.composite(thumbnail_image)
 
         # Save the thumbnail to desired location.
         if image_file is None:
@@ -0,0 +1,315 @@
+import atexit
+import base64
+import contextlib
+import io
+import itertools
+import json
+import math
+import os
+import queue
+import subprocess
+import tempfile
+import threading
+import time
+import urllib.request
+
+from PIL import Image
+from html2image.browsers.chrome import find_chrome
+import websocket
+
+
+# This script lays out a batch of html documents on a single page.
+# Each document goes into its own shadow root, which keeps the style of
+# one document from leaking into another. Browsers ignore @font-face
+# rules inside shadow roots, though, so we hoist those to the page.
+# Once fonts and images are ready, we return the page bounds of each
+# document's .root element.
+_batch_script = """(async (htmls) => {
+    const fonts = new Set();
+    const roots = htmls.map(html => {
+        const host = document.createElement("div");
+        document.body.appendChild(host);
+        const shadow = host.attachShadow({mode: "open"});
+        shadow.innerHTML = html;
+        for (const sheet of shadow.styleSheets) {
+            for (const rule of sheet.cssRules) {
+                if (rule instanceof CSSFontFaceRule) {
+                    fonts.add(rule.cssText);
+                }
+            }
+        }
+        return shadow.querySelector(".root");
+    });
+    const style = document.createElement("style");
+    style.textContent = [...fonts].join("");
+    document.head.appendChild(style);
+
+    void document.body.offsetHeight;
+    await document.fonts.ready;
+    const images = roots.flatMap(root => [...root.querySelectorAll("img")]);
+    await Promise.all(images.map(image => image.decode().catch(() => null)));
+
+    return roots.map(root => {
+        const rect = root.getBoundingClientRect();
+        const x = window.scrollX, y = window.scrollY;
+        return [rect.left + x, rect.top + y, rect.right + x, rect.bottom + y];
+    });
+})(%s)"""
+
+
+class _Browser:
+    # A single warm headless Chrome instance.
+    # Rather than starting a new Chrome process for every screenshot
+    # like html2image does, we start Chrome once and then drive it
+    # over a persistent Chrome DevTools Protocol (CDP) connection.
+    def __init__(self, executable: str, size: tuple[int, int], timeout: float):
+        self.timeout = timeout
+        self.uses = 0
+        self._ids = itertools.count(1)
+
+        # Chrome needs a profile directory, and we also need
+        # somewhere to write the html that we will load.
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.html_file = os.path.join(self.tmpdir.name, "RenderPool.tmp.html")
+
+        # Port 0 lets Chrome choose a free port for the protocol.
+        # Chrome then writes the chosen port to DevToolsActivePort.
+        self.process = subprocess.Popen(
+            [
+                executable,
+                "--headless",
+                "--disable-gpu",
+                "--hide-scrollbars",
+                "--no-first-run",
+                "--no-default-browser-check",
+                "--remote-debugging-port=0",
+                "--remote-allow-origins=*",
+                f"--user-data-dir={self.tmpdir.name}",
+                "about:blank"
+            ],
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL
+        )
+
+        try:
+            self.ws = websocket.create_connection(self._page_websocket_url(), timeout=timeout)
+
+            # Emulate the same window that html2image uses, with a transparent
+            # background so that cropping with getbbox keeps working.
+            self.send("Page.enable")
+            self.send(
+                "Emulation.setDeviceMetricsOverride",
+                width=size[0],
+                height=size[1],
+                deviceScaleFactor=1,
+                mobile=False
+            )
+            self.send("Emulation.setDefaultBackgroundColorOverride", color=dict(r=0, g=0, b=0, a=0))
+        except Exception:
+            self.close()
+            raise
+
+    def _page_websocket_url(self) -> str:
+        port_file = os.path.join(self.tmpdir.name, "DevToolsActivePort")
+        deadline = time.monotonic() + self.timeout
+        while True:
+            if self.process.poll() is not None:
+                raise RuntimeError("Chrome exited before accepting a DevTools connection")
+            try:
+                with open(port_file) as f:
+                    port = int(f.readline())
+                with urllib.request.urlopen(f"http://127.0.0.1:{port}/json/list") as response:
+                    targets = json.load(response)
+                return next(t["webSocketDebuggerUrl"] for t in targets if t["type"] == "page")
+            except (OSError, ValueError, StopIteration):
+                if time.monotonic() > deadline:
+                    raise TimeoutError("timed out waiting for Chrome to start")
+                time.sleep(0.05)
+
+    def _request(self, method: str, **params) -> int:
+        message_id = next(self._ids)
+        self.ws.send(json.dumps(dict(id=message_id, method=method, params=params)))
+        return message_id
+
+    def _receive(self, message_id: int, event: str = None) -> dict:
+        # Read messages until we have the response to our request,
+        # and, if given, until the event has fired as well.
+        # Events may arrive before or after the response.
+        result = None
+        while result is None or event is not None:
+            message = json.loads(self.ws.recv())
+            if message.get("id") == message_id:
+                if "error" in message:
+                    raise RuntimeError(f"DevTools error: {message['error'].get('message')}")
+                result = message.get("result", {})
+            elif message.get("method") == event:
+                event = None
+        return result
+
+    def send(self, method: str, **params) -> dict:
+        return self._receive(self._request(method, **params))
+
+    def load(self, html_str: str):
+        with open(self.html_file, "w", encoding="utf-8") as f:
+            f.write(html_str)
+        self._receive(
+            self._request("Page.navigate", url="file://" + self.html_file),
+            event="Page.loadEventFired"
+        )
+        # Web fonts are loaded lazily, so the load event alone
+        # does not guarantee that our icon font is ready.
+        self.evaluate("document.fonts.ready.then(() => true)")
+
+    def evaluate(self, expression: str):
+        result = self.send("Runtime.evaluate", expression=expression, awaitPromise=True, returnByValue=True)
+        if "exceptionDetails" in result:
+            raise RuntimeError(f"JavaScript error: {result['exceptionDetails'].get('text')}")
+        return result["result"].get("value")
+
+    def capture(self, **params) -> Image.Image:
+        # The screenshot comes back to us base64 encoded,
+        # so we never have to touch the disk to read it.
+        data = self.send("Page.captureScreenshot", format="png", **params)["data"]
+        image = Image.open(io.BytesIO(base64.b64decode(data)))
+        image.load()
+        return image
+
+    def screenshot(self, html_str: str) -> Image.Image:
+        self.load(html_str)
+        return self.capture()
+
+    def screenshot_batch(self, html_strs: list[str]) -> list[Image.Image]:
+        # Load and lay out the whole batch at once, then capture
+        # each document's exact bounds into its own image.
+        self.load("<!DOCTYPE html><html><head></head><body></body></html>")
+        bounds = self.evaluate(_batch_script % json.dumps(html_strs))
+        return [
+            self.capture(
+                clip=dict(
+                    x=math.floor(left),
+                    y=math.floor(top),
+                    width=math.ceil(right) - math.floor(left),
+                    height=math.ceil(bottom) - math.floor(top),
+                    scale=1
+                ),
+                captureBeyondViewport=True
+            )
+            for left, top, right, bottom in bounds
+        ]
+
+    def close(self):
+        if getattr(self, "ws", None) is not None:
+            with contextlib.suppress(Exception):
+                self.ws.close()
+        if self.process.poll() is None:
+            self.process.terminate()
+            try:
+                self.process.wait(self.timeout)
+            except subprocess.TimeoutExpired:
+                self.process.kill()
+                self.process.wait()
+        self.tmpdir.cleanup()
+
+
+class RenderPool:
+    # All html media factories share one pool by default.
+    _shared = None
+    _shared_lock = threading.Lock()
+
+    def __init__(
+            self,
+            size: int = 1,
+            max_uses: int = 1000,
+            window_size: tuple[int, int] = (1920, 1080),
+            executable: str = None,
+            timeout: float = 30,
+            batch_size: int = 16
+    ):
+        if size < 1:
+            raise ValueError("size must be at least 1")
+
+        # size is the maximum number of browsers running at once.
+        # max_uses is how many documents a browser renders before we
+        # restart it, which keeps leaks in long-lived browsers in check.
+        # A batch counts once for each of its documents.
+        self.size = size
+        self.max_uses = max_uses
+        self.window_size = window_size
+        self.executable = find_chrome(executable)
+        self.timeout = timeout
+        # This is how many documents we lay out on one page at most.
+        self.batch_size = batch_size
+
+        # Browsers are started lazily, the first time they are needed.
+        # We reuse the most recently used browser first since it is warm.
+        self._idle = queue.LifoQueue()
+        self._slots = threading.BoundedSemaphore(size)
+        self._closed = False
+
+        atexit.register(self.close)
+
+    @classmethod
+    def shared(cls) -> "RenderPool":
+        with cls._shared_lock:
+            if cls._shared is None:
+                cls._shared = cls()
+            return cls._shared
+
+    @classmethod
+    def configure_shared(cls, **kwargs) -> "RenderPool":
+        # Replace the shared pool, e.g., with a larger one.
+        # kwargs are passed to the RenderPool constructor.
+        with cls._shared_lock:
+            if cls._shared is not None:
+                cls._shared.close()
+            cls._shared = cls(**kwargs)
+            return cls._shared
+
+    @contextlib.contextmanager
+    def browser(self, documents: int = 1):
+        # documents is how many documents we render with the browser.
+        if self._closed:
+            raise RuntimeError("render pool is closed")
+
+        with self._slots:
+            try:
+                browser = self._idle.get_nowait()
+            except queue.Empty:
+                browser = _Browser(self.executable, self.window_size, self.timeout)
+
+            try:
+                yield browser
+            except BaseException:
+                # We do not know what state the browser was left in,
+                # so it is safest to throw it away.
+                browser.close()
+                raise
+
+            browser.uses += documents
+            if self._closed or browser.uses >= self.max_uses:
+                browser.close()
+            else:
+                self._idle.put(browser)
+
+    def screenshot(self, html_str: str) -> Image.Image:
+        with self.browser() as browser:
+            return browser.screenshot(html_str)
+
+    def screenshot_batch(self, html_strs: list[str]) -> list[Image.Image]:
+        # Rendering documents in batches saves a page load and a layout for
+        # every document. Since each image is cropped to the exact bounds of
+        # the document's .root element, there is no need to crop them again.
+        images = []
+        for i in range(0, len(html_strs), self.batch_size):
+            batch = html_strs[i:i + self.batch_size]
+            with self.browser(len(batch)) as browser:
+                images.extend(browser.screenshot_batch(batch))
+        return images
+
+    def close(self):
+        self._closed = True
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except queue.Empty:
+                break
@@ -0,0 +1,32 @@
+import contextlib
+import threading
+
+
+class ResourceLimits:
+    # Process-wide limits on how many threads may use a shared resource
+    # (e.g., "tts" or "ffmpeg") at once, no matter which factory or job
+    # they work for. Browsers are limited by the size of the render pool.
+    # Resources without a limit may be used by any number of threads,
+    # and using them costs next to nothing.
+    _slots = {}
+    _lock = threading.Lock()
+    _unlimited = contextlib.nullcontext()
+
+    @classmethod
+    def configure(cls, **limits: int):
+        # Set the limit of each given resource, e.g., configure(tts=8).
+        # A limit of None removes the limit.
+        # Threads that already hold a slot keep it.
+        with cls._lock:
+            for resource, limit in limits.items():
+                if limit is None:
+                    cls._slots.pop(resource, None)
+                elif limit < 1:
+                    raise ValueError(f"the limit of {resource} must be at least 1")
+                else:
+                    cls._slots[resource] = threading.BoundedSemaphore(limit)
+
+    @classmethod
+    def slot(cls, resource: str):
+        # Hold a slot of the resource for the duration of a with block.
+        return cls._slots.get(resource, cls._unlimited)
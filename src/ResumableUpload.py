@@ -0,0 +1,280 @@
+import hashlib
+import http.client
+import json
+import os
+import random
+import re
+import time
+import typing
+import urllib.error
+import urllib.parse
+import urllib.request
+
+from .Tracer import Tracer
+
+
+class UploadError(Exception):
+    # The server rejected the upload for good.
+    def __init__(self, status: int, body: bytes):
+        self.status = status
+        self.body = body
+        super(UploadError, self).__init__(f"upload failed with status {status}: {body[:200]!r}")
+
+
+class _NoRedirectHandler(urllib.request.HTTPRedirectHandler):
+    # The resumable protocol answers every incomplete chunk with a 308,
+    # which is not a redirect and must not be followed.
+    def redirect_request(self, req, fp, code, msg, headers, newurl):
+        return None
+
+
+class ResumableUpload:
+    # Upload a file with Google's resumable upload protocol:
+    #   1. POST the metadata to the endpoint, which answers with a session uri.
+    #   2. PUT the file to the session uri one chunk at a time. Each incomplete
+    #      chunk is answered with a 308 whose Range header says how many bytes
+    #      the server has, and the last chunk with the uploaded resource.
+    #   3. After an error, PUT an empty body to ask how many bytes the server
+    #      has, and carry on from there.
+    # The session uri is saved to session_file, so an upload that dies with
+    # the process resumes the next time the same file is uploaded.
+    # Anything that looks transient is retried with exponential backoff.
+
+    # Every chunk but the last must be a multiple of this many bytes.
+    chunk_granularity = 256 * 1024
+
+    # These statuses are worth retrying.
+    retry_statuses = (408, 429, 500, 502, 503, 504)
+
+    # These exceptions mean that the connection broke, rather
+    # than that the server rejected what we sent.
+    retry_exceptions = (urllib.error.URLError, http.client.HTTPException, ConnectionError, TimeoutError)
+
+    def __init__(
+            self,
+            file: str,
+            endpoint: str,
+            metadata: dict,
+            content_type: str = "application/octet-stream",
+            authorization: typing.Callable[[bool], str] = None,
+            chunk_size: int = 32 * chunk_granularity,
+            session_file: str = None,
+            retries: int = 8,
+            backoff: float = 1,
+            max_backoff: float = 64,
+            timeout: float = 60,
+            progress: typing.Callable[[int, int, float], None] = None
+    ):
+        # endpoint includes any query parameters besides uploadType, e.g.,
+        # "https://www.googleapis.com/upload/youtube/v3/videos?part=snippet,status".
+        # authorization, if given, returns the value of the Authorization
+        # header, and is passed True when the last one was rejected.
+        # retries is how many errors in a row we put up with; any chunk that
+        # gets through resets the count. progress, if given, is called after
+        # every chunk with the bytes uploaded, the size of the file, and the
+        # average bytes per second of this run.
+        if chunk_size <= 0 or chunk_size % self.chunk_granularity:
+            raise ValueError(f"chunk_size must be a positive multiple of {self.chunk_granularity}, not {chunk_size}")
+
+        self.file = file
+        self.endpoint = endpoint
+        self.metadata = metadata
+        self.content_type = content_type
+        self.authorization = authorization
+        self.chunk_size = chunk_size
+        self.session_file = session_file if session_file is not None else file + ".upload.json"
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.timeout = timeout
+        self.progress = progress
+
+        self.size = os.path.getsize(file)
+        self.uri = None
+        self.offset = 0
+        self.sent = 0
+        self.seconds = 0
+        self._opener = urllib.request.build_opener(_NoRedirectHandler)
+
+    @property
+    def bytes_per_second(self) -> float:
+        # Only count what this run sent, since a resumed upload
+        # may have sent most of the file long ago.
+        return self.sent / self.seconds if self.seconds else 0
+
+    def _session_key(self) -> str:
+        # A saved session is only good for the same file, uploaded
+        # to the same endpoint, with the same metadata.
+        stat = os.stat(self.file)
+        return hashlib.sha256(json.dumps(
+            [os.path.abspath(self.file), stat.st_size, stat.st_mtime_ns, self.endpoint, self.metadata],
+            sort_keys=True
+        ).encode()).hexdigest()
+
+    def _load_session(self) -> typing.Optional[str]:
+        try:
+            with open(self.session_file) as f:
+                session = json.load(f)
+        except (FileNotFoundError, ValueError):
+            return None
+        return session["uri"] if session.get("key") == self._session_key() else None
+
+    def _save_session(self):
+        # Write to a temporary file first so that a crash
+        # never leaves a half-written session behind.
+        tmp_file = self.session_file + ".tmp"
+        with open(tmp_file, "w") as f:
+            json.dump({"key": self._session_key(), "uri": self.uri}, f)
+        os.replace(tmp_file, self.session_file)
+
+    def _remove_session(self):
+        try:
+            os.remove(self.session_file)
+        except FileNotFoundError:
+            pass
+
+    def _request(
+            self,
+            method: str,
+            url: str,
+            data: bytes = None,
+            headers: dict = None
+    ) -> tuple[int, http.client.HTTPMessage, bytes]:
+        # Return the status, headers, and body of the response,
+        # whether or not the status is an error.
+        headers = dict(headers or {})
+        if self.authorization is not None:
+            headers["Authorization"] = self.authorization(False)
+        request = urllib.request.Request(url, data=data, headers=headers, method=method)
+        try:
+            with self._opener.open(request, timeout=self.timeout) as response:
+                return response.status, response.headers, response.read()
+        except urllib.error.HTTPError as e:
+            with e:
+                return e.code, e.headers, e.read()
+
+    def _start(self) -> tuple[int, http.client.HTTPMessage, bytes]:
+        separator = "&" if urllib.parse.urlsplit(self.endpoint).query else "?"
+        return self._request(
+            "POST",
+            self.endpoint + separator + "uploadType=resumable",
+            json.dumps(self.metadata).encode(),
+            {
+                "Content-Type": "application/json; charset=UTF-8",
+                "X-Upload-Content-Length": str(self.size),
+                "X-Upload-Content-Type": self.content_type
+            }
+        )
+
+    def _query(self) -> tuple[int, http.client.HTTPMessage, bytes]:
+        return self._request("PUT", self.uri, b"", {"Content-Range": f"bytes */{self.size}"})
+
+    def _send(self) -> tuple[int, http.client.HTTPMessage, bytes]:
+        with open(self.file, "rb") as f:
+            f.seek(self.offset)
+            data = f.read(self.chunk_size)
+
+        headers = {"Content-Type": self.content_type}
+        if data:
+            headers["Content-Range"] = f"bytes {self.offset}-{self.offset + len(data) - 1}/{self.size}"
+        else:
+            # An empty file is uploaded with one empty request.
+            headers["Content-Range"] = f"bytes */{self.size}"
+
+        Tracer.count("upload requests")
+        start = time.monotonic()
+        with Tracer.span("upload chunk", bytes=len(data)):
+            response = self._request("PUT", self.uri, data, headers)
+        self.seconds += time.monotonic() - start
+        return response
+
+    @staticmethod
+    def _received(headers: http.client.HTTPMessage) -> int:
+        # The Range header of a 308 is the range of bytes the server has,
+        # e.g., "bytes=0-524287". Without one, the server has nothing.
+        match = re.fullmatch(r"bytes=0-(\d+)", headers.get("Range", ""))
+        return 0 if match is None else int(match[1]) + 1
+
+    def upload(self) -> dict:
+        # Upload the file and return the uploaded resource.
+        self.uri = self._load_session()
+        resuming = self.uri is not None
+        errors = 0
+        refreshed = False
+
+        while True:
+            try:
+                if self.uri is None:
+                    status, headers, body = self._start()
+                    if status in (200, 201):
+                        self.uri = headers["Location"]
+                        self._save_session()
+                        self.offset = 0
+                        continue
+                elif resuming:
+                    status, headers, body = self._query()
+                else:
+                    before = self.offset
+                    status, headers, body = self._send()
+                    if status == 308:
+                        self.offset = self._received(headers)
+                        self.sent += max(0, self.offset - before)
+                        Tracer.count("bytes uploaded", max(0, self.offset - before))
+                    elif status in (200, 201):
+                        self.sent += self.size - before
+                        Tracer.count("bytes uploaded", self.size - before)
+            except self.retry_exceptions as e:
+                status, headers, body, error = None, None, None, e
+            else:
+                error = None
+
+            if status in (200, 201):
+                # The server has the whole file, whether it just got the last
+                # chunk or we asked about a session that already finished.
+                self.offset = self.size
+                self._remove_session()
+                self._report()
+                return json.loads(body) if body else {}
+
+            if status == 308:
+                if resuming:
+                    self.offset = self._received(headers)
+                resuming = False
+                errors = 0
+                refreshed = False
+                self._report()
+                continue
+
+            if status == 401 and not refreshed and self.authorization is not None:
+                # The access token expired mid upload, so
+                # refresh it once and try again right away.
+                refreshed = True
+                self.authorization(True)
+                resuming = self.uri is not None
+                continue
+
+            if status in (404, 410):
+                # The session expired, so we have to start over.
+                self.uri = None
+                resuming = False
+                self._remove_session()
+                continue
+
+            if status is not None and status not in self.retry_statuses:
+                raise UploadError(status, body)
+
+            # We do not know what the server got before things went wrong,
+            # so we ask before sending anything else.
+            errors += 1
+            if errors > self.retries:
+                if error is not None:
+                    raise error
+                raise UploadError(status, body)
+            Tracer.count("upload retries")
+            delay = min(self.max_backoff, self.backoff * 2 ** (errors - 1))
+            time.sleep(delay * random.uniform(0.5, 1))
+            resuming = self.uri is not None
+
+    def _report(self):
+        if self.progress is not None:
+            self.progress(self.offset, self.size, self.bytes_per_second)
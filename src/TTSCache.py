@@ -0,0 +1,118 @@
+import contextlib
+import hashlib
+import os
+import tempfile
+import threading
+import typing
+
+
+class TTSCache:
+    # A persistent, content-addressed cache of text-to-speech responses.
+    # Entries are keyed on everything that determines the synthesized
+    # audio (i.e., the ssml, the voice, and the audio config), so the same
+    # request never has to be paid for twice, even across runs.
+    # The cache is bounded by max_bytes and evicts the least recently used
+    # entries first. Recency is tracked with file modification times,
+    # which lets several processes share one cache directory.
+
+    # Once over max_bytes, we evict down to this fraction of it, so that
+    # the scan of the whole cache is paid for once in a while rather than
+    # on every put after the cache fills up.
+    low_water = 0.9
+
+    def __init__(self, directory: str, max_bytes: int = 1 << 30):
+        self.directory = directory
+        self.max_bytes = max_bytes
+
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+        os.makedirs(self.directory, exist_ok=True)
+        self._size = sum(size for _, _, size in self._entries())
+
+    @staticmethod
+    def key(data: bytes) -> str:
+        return hashlib.sha256(data).hexdigest()
+
+    def _path(self, key: str) -> str:
+        # Shard entries into subdirectories so that
+        # no single directory grows too large.
+        return os.path.join(self.directory, key[:2], key)
+
+    def _entries(self):
+        for entry in os.scandir(self.directory):
+            if not entry.is_dir():
+                continue
+            for file in os.scandir(entry.path):
+                # Skip partially written files.
+                if file.name.endswith(".tmp"):
+                    continue
+                with contextlib.suppress(FileNotFoundError):
+                    stat = file.stat()
+                    yield file.path, stat.st_mtime, stat.st_size
+
+    def get(self, key: str) -> typing.Optional[bytes]:
+        path = self._path(key)
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+        except FileNotFoundError:
+            # The entry never existed or was evicted by another process.
+            with self._lock:
+                self.misses += 1
+            return None
+
+        # Mark the entry as recently used.
+        with contextlib.suppress(FileNotFoundError):
+            os.utime(path)
+
+        with self._lock:
+            self.hits += 1
+        return data
+
+    def put(self, key: str, data: bytes):
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        # Write to a temporary file first and then atomically move it into
+        # place, so that concurrent readers never see a partial entry.
+        fd, tmppath = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            os.replace(tmppath, path)
+        except BaseException:
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(tmppath)
+            raise
+
+        with self._lock:
+            self._size += len(data)
+            if self._size > self.max_bytes:
+                self._evict()
+
+    def _evict(self):
+        # Our running size is only an estimate when other processes share
+        # the directory, so let's recount before evicting anything.
+        entries = sorted(self._entries(), key=lambda entry: entry[1])
+        self._size = sum(size for _, _, size in entries)
+        if self._size <= self.max_bytes:
+            return
+        for path, _, size in entries:
+            if self._size <= self.max_bytes * self.low_water:
+                break
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(path)
+            self._size -= size
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return dict(
+                hits=self.hits,
+                misses=self.misses,
+                hit_rate=self.hits / lookups if lookups else 0.0,
+                bytes=self._size,
+                max_bytes=self.max_bytes
+            )
@@ -0,0 +1,140 @@
+import concurrent.futures
+import itertools
+import random
+import threading
+import time
+
+from google.api_core import exceptions
+
+from .Tracer import Tracer
+from .TTSCache import TTSCache
+from .utils import synthesize_speech, texttospeech
+
+
+class TTSClient:
+    # A long-lived text-to-speech client shared by every title and comment.
+    # Every TextToSpeechClient opens its own gRPC channel, so we create
+    # our channels once, on first use, and keep them for good. A channel
+    # multiplexes concurrent calls over one connection, and calls take
+    # turns across channels when there are several.
+    # Requests are sent from a pool of max_in_flight threads, so that many
+    # requests can be in flight at once no matter who submitted them.
+    # If given requests_per_second, requests are spaced out to stay under
+    # it. Transient errors are retried with exponential backoff, and when
+    # we run out of quota, every request backs off, not just the one that
+    # was told so.
+    # The backend is anything with the synthesize_speech(request=...) method
+    # of a TextToSpeechClient, e.g., an OfflineTTSBackend, which needs no
+    # network. By default, the backend is Google's.
+    _shared = None
+    _shared_lock = threading.Lock()
+
+    # These errors are worth retrying.
+    retry_exceptions = (
+        exceptions.ResourceExhausted,
+        exceptions.ServiceUnavailable,
+        exceptions.DeadlineExceeded,
+        exceptions.InternalServerError
+    )
+
+    def __init__(
+            self,
+            backend=None,
+            channels: int = 1,
+            max_in_flight: int = 8,
+            requests_per_second: float = None,
+            retries: int = 6,
+            backoff: float = 1,
+            max_backoff: float = 32
+    ):
+        if channels < 1 or max_in_flight < 1:
+            raise ValueError("channels and max_in_flight must be at least 1")
+
+        self.channels = channels
+        self.max_in_flight = max_in_flight
+        self.requests_per_second = requests_per_second
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+
+        self._backends = None if backend is None else [backend]
+        self._backends_lock = threading.Lock()
+        self._turns = itertools.count()
+
+        # Requests may not start before _next_start, which spaces them out,
+        # or before _paused_until, which is pushed back when we are out of quota.
+        self._next_start = 0
+        self._paused_until = 0
+        self._rate_lock = threading.Lock()
+
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_in_flight)
+
+    @classmethod
+    def shared(cls) -> "TTSClient":
+        with cls._shared_lock:
+            if cls._shared is None:
+                cls._shared = cls()
+            return cls._shared
+
+    @classmethod
+    def configure_shared(cls, **kwargs) -> "TTSClient":
+        # Replace the shared client, e.g., with one that allows more
+        # requests in flight. kwargs are passed to TTSClient.
+        with cls._shared_lock:
+            if cls._shared is not None:
+                cls._shared.close()
+            cls._shared = cls(**kwargs)
+            return cls._shared
+
+    def close(self):
+        # Wait for any requests in flight.
+        self._executor.shutdown(wait=True)
+
+    def _backend(self):
+        with self._backends_lock:
+            if self._backends is None:
+                self._backends = [texttospeech.TextToSpeechClient() for _ in range(self.channels)]
+        return self._backends[next(self._turns) % len(self._backends)]
+
+    def _wait_turn(self):
+        with self._rate_lock:
+            now = time.monotonic()
+            start = max(now, self._next_start, self._paused_until)
+            if self.requests_per_second is not None:
+                self._next_start = start + 1 / self.requests_per_second
+        if start > now:
+            time.sleep(start - now)
+
+    def synthesize_speech(
+            self,
+            request: texttospeech.SynthesizeSpeechRequest = None,
+            **kwargs
+    ) -> texttospeech.SynthesizeSpeechResponse:
+        # Synthesize speech and wait for it, just like a TextToSpeechClient.
+        errors = 0
+        while True:
+            self._wait_turn()
+            try:
+                return self._backend().synthesize_speech(request=request, **kwargs)
+            except self.retry_exceptions as e:
+                errors += 1
+                if errors > self.retries:
+                    raise
+                Tracer.count("tts retries")
+                delay = min(self.max_backoff, self.backoff * 2 ** (errors - 1)) * random.uniform(0.5, 1)
+                if isinstance(e, exceptions.ResourceExhausted):
+                    # Any other request would only run out of quota as well.
+                    with self._rate_lock:
+                        self._paused_until = max(self._paused_until, time.monotonic() + delay)
+                else:
+                    time.sleep(delay)
+
+    def submit(
+            self,
+            request: texttospeech.SynthesizeSpeechRequest,
+            cache: TTSCache = None
+    ) -> concurrent.futures.Future:
+        # Send the request without waiting for it. The future's result is the
+        # response, which comes straight from the cache, if given, when we
+        # have synthesized this exact request before.
+        return self._executor.submit(synthesize_speech, self, request, cache)
@@ -0,0 +1,170 @@
+import collections
+import contextlib
+import json
+import os
+import threading
+import time
+import typing
+
+
+class _Span:
+    # A span times a block of code on the thread that runs it.
+    def __init__(self, tracer: "Tracer", name: str, category: str, args: dict):
+        self.tracer = tracer
+        self.name = name
+        self.category = category
+        self.args = args
+
+    def __enter__(self) -> "_Span":
+        self.start_ns = time.perf_counter_ns()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        end_ns = time.perf_counter_ns()
+        if exc_type is not None:
+            self.args["error"] = repr(exc_value)
+        self.tracer._add_span(self, end_ns)
+
+
+class Tracer:
+    # A tracer records how long every stage of manufacturing takes, as
+    # spans, and how much work is done, as counters (e.g., renders,
+    # text-to-speech requests, bytes written, and ffmpeg invocations).
+    # Tracing is off unless a tracer is active:
+    #
+    #   tracer = Tracer()
+    #   with tracer:
+    #       factory.manufacture_video()
+    #   tracer.save_report("report.json")
+    #   tracer.save_chrome_trace("trace.json")
+    #
+    # The trace can be opened in chrome://tracing or in Perfetto.
+    # While no tracer is active, Tracer.span and Tracer.count do next to
+    # nothing, so the instrumentation may stay in place for good.
+    _current = None
+    _null_span = contextlib.nullcontext()
+
+    def __init__(self):
+        self.spans = []
+        self.counters = collections.Counter()
+        # Counters are also recorded over time for the trace.
+        self.counter_events = []
+        self._lock = threading.Lock()
+        self._origin_ns = time.perf_counter_ns()
+        self._end_ns = None
+
+    def __enter__(self) -> "Tracer":
+        if Tracer._current is not None:
+            raise RuntimeError("another tracer is already active")
+        self._origin_ns = time.perf_counter_ns()
+        self._end_ns = None
+        Tracer._current = self
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self._end_ns = time.perf_counter_ns()
+        Tracer._current = None
+
+    @classmethod
+    def current(cls) -> typing.Optional["Tracer"]:
+        return cls._current
+
+    @classmethod
+    def span(cls, name: str, category: str = "stage", **args):
+        # Time the block of code under the given name.
+        # args are kept with the span, e.g., the id of a comment.
+        tracer = cls._current
+        if tracer is None:
+            return cls._null_span
+        return _Span(tracer, name, category, args)
+
+    @classmethod
+    def count(cls, name: str, value: int = 1):
+        tracer = cls._current
+        if tracer is not None:
+            tracer._add_count(name, value)
+
+    @classmethod
+    def count_file(cls, file: str):
+        # Count the size of a file that we just wrote.
+        # We only pay for the stat when tracing.
+        tracer = cls._current
+        if tracer is not None:
+            tracer._add_count("bytes written", os.path.getsize(file))
+
+    def _add_span(self, span: _Span, end_ns: int):
+        with self._lock:
+            self.spans.append((
+                span.name,
+                span.category,
+                span.start_ns - self._origin_ns,
+                end_ns - span.start_ns,
+                threading.get_ident(),
+                span.args
+            ))
+
+    def _add_count(self, name: str, value: int):
+        with self._lock:
+            self.counters[name] += value
+            self.counter_events.append((name, time.perf_counter_ns() - self._origin_ns, self.counters[name]))
+
+    def report(self) -> dict:
+        # Summarize the spans by name. Since stages run on several threads
+        # at once, the total time of the stages may exceed the wall time.
+        end_ns = self._end_ns if self._end_ns is not None else time.perf_counter_ns()
+        with self._lock:
+            spans = list(self.spans)
+            counters = dict(self.counters)
+
+        stages = {}
+        units = []
+        for name, category, _, duration_ns, _, args in spans:
+            stage = stages.setdefault(name, {"count": 0, "total_seconds": 0.0, "max_seconds": 0.0})
+            stage["count"] += 1
+            stage["total_seconds"] += duration_ns / 1e9
+            stage["max_seconds"] = max(stage["max_seconds"], duration_ns / 1e9)
+            if category == "unit":
+                units.append(dict(args, seconds=duration_ns / 1e9))
+        for stage in stages.values():
+            stage["mean_seconds"] = stage["total_seconds"] / stage["count"]
+
+        return {
+            "wall_seconds": (end_ns - self._origin_ns) / 1e9,
+            "stages": stages,
+            "counters": counters,
+            "units": units
+        }
+
+    def chrome_trace(self) -> dict:
+        # See the Trace Event Format for what these fields mean.
+        # Timestamps and durations are in microseconds.
+        pid = os.getpid()
+        with self._lock:
+            events = [
+                {
+                    "name": name,
+                    "cat": category,
+                    "ph": "X",
+                    "ts": start_ns / 1000,
+                    "dur": duration_ns / 1000,
+                    "pid": pid,
+                    "tid": tid,
+                    "args": args
+                }
+                for name, category, start_ns, duration_ns, tid, args in self.spans
+            ]
+            events.extend(
+                {"name": name, "ph": "C", "ts": ts_ns / 1000, "pid": pid, "args": {name: value}}
+                for name, ts_ns, value in self.counter_events
+            )
+        return {"traceEvents": events, "displayTimeUnit": "ms"}
+
+    def save_report(self, report_file: str) -> str:
+        with open(report_file, "w") as f:
+            json.dump(self.report(), f, indent=2, default=repr)
+        return report_file
+
+    def save_chrome_trace(self, trace_file: str) -> str:
+        with open(trace_file, "w") as f:
+            json.dump(self.chrome_trace(), f, default=repr)
+        return trace_file
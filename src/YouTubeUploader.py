@@ -1,13 +1,26 @@
+import mimetypes
+import typing
+import urllib.parse
+
+from oauth2client import transport
+from oauth2client.file import Storage
 from simple_youtube_api.Channel import Channel
-from simple_youtube_api.LocalVideo import LocalVideo
+
+from .ResumableUpload import ResumableUpload
+from .Tracer import Tracer
 
 
 class YouTubeUploader:
+    # The default endpoints of the YouTube Data API. Both can be pointed
+    # at a local stand-in server, which needs no credentials.
+    video_endpoint = "https://www.googleapis.com/upload/youtube/v3/videos"
+    thumbnail_endpoint = "https://www.googleapis.com/upload/youtube/v3/thumbnails/set"
+
     def __init__(
             self,
             video_file: str,
-            credentials: str,
-            storage: str,
+            credentials: typing.Optional[str],
+            storage: typing.Optional[str],
             /,
             *,
             thumbnail: str,
@@ -20,7 +33,18 @@ class YouTubeUploader:
             license_: str = "creativeCommon",
             privacy_status: str = "public",
             public_stats_viewable: bool = True,
+            chunk_size: int = 32 * ResumableUpload.chunk_granularity,
+            session_file: str = None,
+            retries: int = 8,
+            progress: typing.Callable[[int, int, float], None] = None,
+            video_endpoint: str = None,
+            thumbnail_endpoint: str = None
     ):
+        # The video is uploaded in chunks of chunk_size bytes, and an upload
+        # that is interrupted resumes from session_file (by default, next to
+        # the video) the next time the same video is uploaded.
+        # See ResumableUpload for retries and progress.
+        # If credentials and storage are None, nothing is authorized.
         self.video_file = video_file
         self.thumbnail = thumbnail
         self.title = title
@@ -32,25 +56,77 @@ class YouTubeUploader:
         self.license = license_
         self.privacy_status = privacy_status
         self.public_stats_viewable = public_stats_viewable
-        self.channel = self._login(credentials, storage)
+        self.chunk_size = chunk_size
+        self.session_file = session_file
+        self.retries = retries
+        self.progress = progress
+        self.video_endpoint = video_endpoint if video_endpoint is not None else self.video_endpoint
+        self.thumbnail_endpoint = thumbnail_endpoint if thumbnail_endpoint is not None else self.thumbnail_endpoint
+        self.credentials = None if credentials is None else self._login(credentials, storage)
+        self.bytes_per_second = None
 
     @staticmethod
-    def _login(credentials: str, storage: str) -> Channel:
+    def _login(credentials: str, storage: str):
+        # Logging in runs the OAuth flow the first time, and saves
+        # the resulting credentials to storage. We then use the
+        # stored credentials to authorize our own requests.
         channel = Channel()
         channel.login(credentials, storage)
-        return channel
-
-    def upload(self):
-        video = LocalVideo(self.video_file)
-        video.set_thumbnail_path(self.thumbnail)
-        video.set_title(self.title)
-        video.set_description(self.description)
-        video.set_category(self.category)
-        video.set_tags(self.tags or [])
-        video.set_default_language(self.default_language)
-        video.set_embeddable(self.embeddable)
-        video.set_license(self.license)
-        video.set_privacy_status(self.privacy_status)
-        video.set_public_stats_viewable(self.public_stats_viewable)
-
-        self.channel.upload_video(video)
+        return Storage(storage).get()
+
+    def _authorization(self, refresh: bool = False) -> str:
+        if refresh:
+            self.credentials.refresh(transport.get_http_object())
+        return "Bearer " + self.credentials.get_access_token().access_token
+
+    def _metadata(self) -> dict:
+        return {
+            "snippet": {
+                "title": self.title,
+                "description": self.description,
+                "tags": self.tags or [],
+                "categoryId": self.category,
+                "defaultLanguage": self.default_language
+            },
+            "status": {
+                "embeddable": self.embeddable,
+                "license": self.license,
+                "privacyStatus": self.privacy_status,
+                "publicStatsViewable": self.public_stats_viewable
+            }
+        }
+
+    def upload(self) -> str:
+        # Upload the video and then its thumbnail, and return the video id.
+        upload = ResumableUpload(
+            self.video_file,
+            self.video_endpoint + "?part=snippet,status",
+            self._metadata(),
+            content_type=mimetypes.guess_type(self.video_file)[0] or "video/*",
+            authorization=None if self.credentials is None else self._authorization,
+            chunk_size=self.chunk_size,
+            session_file=self.session_file,
+            retries=self.retries,
+            progress=self.progress
+        )
+        with Tracer.span("upload video"):
+            video_id = upload.upload()["id"]
+        self.bytes_per_second = upload.bytes_per_second
+
+        if self.thumbnail is not None:
+            with Tracer.span("upload thumbnail"):
+                self._upload_thumbnail(video_id)
+        return video_id
+
+    def _upload_thumbnail(self, video_id: str):
+        # Thumbnails fit in one chunk, but go through the same resumable
+        # upload so that they are retried just like the video.
+        upload = ResumableUpload(
+            self.thumbnail,
+            self.thumbnail_endpoint + "?" + urllib.parse.urlencode({"videoId": video_id}),
+            {},
+            content_type=mimetypes.guess_type(self.thumbnail)[0] or "image/jpeg",
+            authorization=None if self.credentials is None else self._authorization,
+            retries=self.retries
+        )
+        upload.upload()
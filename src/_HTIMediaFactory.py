@@ -1,10 +1,154 @@
-import html2image
+import json
+import math
+import os
+import typing
 
+from PIL import Image, ImageDraw
+
+from .AssetCache import AssetCache
+from .html_formats import vote_font_url
 from ._MediaFactory import _MediaFactory
+from .OutputProfile import OutputProfile
+from .RenderPool import RenderPool
+from .Tracer import Tracer
 
 
 class _HTIMediaFactory(_MediaFactory):
-    def __init__(self):
-        super(_HTIMediaFactory, self).__init__()
+    # These are the supported strategies for producing
+    # the images that progressively reveal text.
+    #   "render": render the html once for every prefix of the text.
+    #   "mask": render the html once with all the text, then derive
+    #           each prefix's image by masking out the text after it.
+    reveal_modes = ("render", "mask")
+
+    # When masking, this empty element is placed after every text cut
+    # so that we can find out where each cut ends on the page.
+    reveal_marker = "<i class=reveal-marker></i>"
+
+    # This script measures the page for masking. It must run with the
+    # bottom container hidden, so that we can measure the space below
+    # the last line of text. Then, it shows the bottom container,
+    # since the last image displays the bottom container, and measures
+    # the whole root, which we capture even beyond the viewport.
+    # Markers that did not make it into the page as elements are simply
+    # missing, so the script must not assume there are any.
+    _reveal_script = """(() => {
+        const rect = e => e.getBoundingClientRect();
+        const root = rect(document.querySelector(".root"));
+        const text = rect(document.querySelector(%s));
+        const markers = [...document.querySelectorAll(".reveal-marker")].map(e => {
+            const r = rect(e);
+            return [r.left, r.top, r.bottom];
+        });
+        const tail = markers.length ? root.bottom - markers[markers.length - 1][2] : 0;
+        document.querySelector(".bottom-container").style.display = "flex";
+        const page = rect(document.querySelector(".root"));
+        return {text: [text.left, text.right], markers: markers, tail: tail, page: [page.right, page.bottom]};
+    })()"""
+
+    def __init__(
+            self,
+            render_pool: RenderPool = None,
+            reveal: str = "render",
+            directory: str = None,
+            asset_cache: AssetCache = None
+    ):
+        if reveal not in self.reveal_modes:
+            raise ValueError(f"reveal must be one of {self.reveal_modes}, not {reveal!r}")
+
+        super(_HTIMediaFactory, self).__init__(directory)
+
+        # Rendering html is expensive, so all html media factories
+        # share a pool of warm browsers unless told otherwise.
+        self.render_pool = render_pool if render_pool is not None else RenderPool.shared()
+        self.reveal = reveal
+
+        # Remote assets are inlined into the html as data uris,
+        # so renders never wait on the network.
+        self.asset_cache = asset_cache if asset_cache is not None else AssetCache.shared()
+
+    def inline(self, url: str) -> str:
+        return self.asset_cache.data_uri(url)
+
+    @property
+    def vote_font(self) -> str:
+        return self.inline(vote_font_url)
+
+    def save_images(self, images: list[Image.Image], stem: str, profile: OutputProfile = None) -> list[str]:
+        # Write the images to disk, either as they are, or, if given
+        # a profile, composited onto whole frames of the profile.
+        image_files = []
+        for i, image in enumerate(images):
+            image_file = os.path.join(self.tmpdir.name, f"{stem}.{i}.png")
+            if profile is None:
+                image.save(image_file)
+            else:
+                with Tracer.span("composite"):
+                    profile.composite(image).save(image_file)
+            Tracer.count_file(image_file)
+            image_files.append(image_file)
+        return image_files
+
+    def screenshot(self, html_str: str) -> Image.Image:
+        Tracer.count("renders")
+        with Tracer.span("render", documents=1):
+            return self.render_pool.screenshot(html_str)
+
+    def screenshot_batch(self, html_strs: list[str]) -> list[Image.Image]:
+        Tracer.count("renders", len(html_strs))
+        with Tracer.span("render", documents=len(html_strs)):
+            return self.render_pool.screenshot_batch(html_strs)
+
+    def screenshot_reveal(self, html_str: str, text_selector: str, cuts: int) -> typing.Optional[list[Image.Image]]:
+        # The html must contain the text with a reveal marker after every cut
+        # and the bottom container hidden. We return one cropped image per
+        # cut, which looks as if we had rendered only the text up to that cut.
+        # A marker can end up as text rather than an element (e.g., inside
+        # a markdown code span), in which case we cannot tell where its cut
+        # ends, and we return None for the caller to render every cut instead.
+        Tracer.count("renders")
+        with Tracer.span("render", documents=1), self.render_pool.browser() as browser:
+            browser.load(html_str)
+            layout = browser.evaluate(self._reveal_script % json.dumps(text_selector))
+            if len(layout["markers"]) != cuts:
+                Tracer.count("reveal fallbacks")
+                return None
+            # We capture from the top left corner of the page, rather than
+            # the root's exact bounds, so that the layout's coordinates
+            # are the image's coordinates as well.
+            right, bottom = layout["page"]
+            image = browser.capture(
+                clip=dict(x=0, y=0, width=math.ceil(right), height=math.ceil(bottom), scale=1),
+                captureBeyondViewport=True
+            )
+
+        with Tracer.span("mask"):
+            return self._mask_images(image, layout)
+
+    @staticmethod
+    def _mask_images(image: Image.Image, layout: dict) -> list[Image.Image]:
+        text_left, text_right = math.floor(layout["text"][0]), math.ceil(layout["text"][1])
+        markers = layout["markers"]
+        bbox = image.getbbox()
+
+        images = []
+        for i, (left, top, bottom) in enumerate(markers):
+            # The last image is simply the entire render.
+            if i == len(markers) - 1:
+                images.append(image.crop(bbox))
+                break
+
+            # Otherwise, the image ends below the cut's line of text with the
+            # same spacing that follows the text when it is all rendered.
+            # Then, we hide the rest of the cut's line and anything else that
+            # would still show up above the bottom of the image.
+            # (26, 26, 27) are the RGB values corresponding to
+            # hex color #1A1A1B, the comment background color.
+            end = round(bottom + layout["tail"])
+            masked_image = image.copy()
+            draw = ImageDraw.Draw(masked_image)
+            draw.rectangle((math.floor(left), math.floor(top), text_right, math.ceil(bottom)), fill=(26, 26, 27, 255))
+            draw.rectangle((text_left, math.ceil(bottom), text_right, end), fill=(26, 26, 27, 255))
+            images.append(masked_image.crop((bbox[0], bbox[1], bbox[2], end)))
 
-        self.hti = html2image.Html2Image(output_path=self.tmpdir.name)
+        return images
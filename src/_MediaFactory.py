@@ -1,7 +1,24 @@
+import os
 import tempfile
 
 
+class _PersistentDirectory:
+    # This stands in for a TemporaryDirectory that outlives the factory.
+    def __init__(self, name: str):
+        # Like a TemporaryDirectory's, the name is absolute.
+        self.name = os.path.abspath(name)
+        os.makedirs(self.name, exist_ok=True)
+
+    def cleanup(self):
+        pass
+
+
 class _MediaFactory:
-    def __init__(self):
+    def __init__(self, directory: str = None):
         # Create a temporary directory in which to save intermediate files.
-        self.tmpdir = tempfile.TemporaryDirectory()
+        # If we are given a directory, we save them there instead,
+        # and they are kept around after the factory is gone.
+        if directory is None:
+            self.tmpdir = tempfile.TemporaryDirectory()
+        else:
+            self.tmpdir = _PersistentDirectory(directory)
@@ -1,27 +1,51 @@
 import itertools
 import html
-import os
 import random
 
+import markdown
 from PIL import Image
 import praw.models
-from google.cloud import texttospeech
 
+from .AssetCache import AssetCache
 from .html_formats import comment_html_format
-from ._HTIMediaFactory import _HTIMediaFactory
-from .utils import format_score, random_voice_params, text_cuts
+from .OutputProfile import OutputProfile, landscape
+from .RenderPool import RenderPool
+from ._SpeechMediaFactory import _SpeechMediaFactory
+from .TTSCache import TTSCache
+from .TTSClient import TTSClient
+from .utils import format_score
 
 
-class _RedditCommentMediaFactory(_HTIMediaFactory):
+class _RedditCommentMediaFactory(_SpeechMediaFactory):
     # These hex codes correspond to background colors for default reddit avatars.
     # They are present in URLs that return default reddit avatar images.
     avatar_colors = ["0079D3", "0DD3BB", "24A0ED", "FF4500", "FF8717", "FFB000"]
 
-    def __init__(self, comment: praw.models.Comment):
+    def __init__(
+            self,
+            comment: praw.models.Comment,
+            render_pool: RenderPool = None,
+            tts_cache: TTSCache = None,
+            reveal: str = "render",
+            directory: str = None,
+            asset_cache: AssetCache = None,
+            tts_client: TTSClient = None
+    ):
         self.comment = comment
-        self._text_cuts = text_cuts(self.comment.body)
 
-        super(_RedditCommentMediaFactory, self).__init__()
+        super(_RedditCommentMediaFactory, self).__init__(
+            self.comment.body,
+            render_pool,
+            tts_cache,
+            reveal,
+            directory,
+            asset_cache,
+            tts_client
+        )
+
+    @property
+    def stem(self) -> str:
+        return self.comment.id
 
     @classmethod
     def randavatarurl(cls):
@@ -30,18 +54,37 @@ class _RedditCommentMediaFactory(_HTIMediaFactory):
             random.choice(cls.avatar_colors)
         )
 
-    def manufacture_images(self) -> list[str]:
-        image_files = []
+    def manufacture_cards(self) -> list[Image.Image]:
+        # A card is the image of the comment, with each cut and its
+        # preceding text, cropped down to the comment itself.
+        # Cards stay in memory; they are not written to disk.
 
         # Either use the commenter's actual profile picture,
         # or use a random default avatar.
         # We use getattr since icon_img will not be a valid attribute
         # for suspended/banned accounts according to PRAW documentation.
         # We then fall back to a random default avatar.
-        pfp_url = getattr(self.comment.author, "icon_img", self.randavatarurl())
+        # Either way, we inline the picture into the html.
+        pfp_url = self.inline(getattr(self.comment.author, "icon_img", self.randavatarurl()))
+
+        if self.reveal == "mask":
+            return self._reveal_images(pfp_url)
+        return self._render_images(pfp_url)
+
+    def manufacture_images(self, profile: OutputProfile = landscape) -> list[str]:
+        # Paste every card onto a whole frame of the profile,
+        # and write the frames to disk.
+        return self.save_images(self.manufacture_cards(), self.stem, profile)
+
+    def manufacture_card_files(self) -> list[str]:
+        # Write the cards to disk as they are, to be composited by ffmpeg.
+        return self.save_images(self.manufacture_cards(), self.stem)
+
+    def _render_images(self, pfp_url: str) -> list[Image.Image]:
+        comment_htmls = []
 
         # Loop through the accumulation of cuts.
-        # We want to save an image of the comment
+        # We want an image of the comment
         # with each cut and its preceding text.
         for i, cut in enumerate(itertools.accumulate(self._text_cuts)):
             # Note that there are probably various pesky
@@ -51,66 +94,48 @@ class _RedditCommentMediaFactory(_HTIMediaFactory):
             # However, since we are formatting text into html, we should
             # replace newline characters with html line breaks.
             cut = cut.replace("\n", "<br/>")
+            # Then, convert the markdown to html ourselves,
+            # rather than loading a markdown script into every page.
+            cut = markdown.markdown(cut)
 
-            # First, format and screenshot the html using html2image.
-            # We must also write this image to disk.
             # Note the first parameter in the format call.
             # It specifies that the bottom container display only if
             # we are up to the last cut.
-            comment_html = comment_html_format.format(
-                "flex" if i == len(self._text_cuts) - 1 else "none",
-                pfp_url,
-                getattr(self.comment.author, "name", "anonymous"),
-                cut,
-                format_score(self.comment.score)
-            )
-            self.hti.screenshot(html_str=comment_html, save_as="RedditCommentMediaFactory.tmphti.png")
-
-            # Next, crop the image because html2image isn't perfect.
-            comment_image = Image.open(os.path.join(self.tmpdir.name, "RedditCommentMediaFactory.tmphti.png"))
-            comment_image = comment_image.crop(comment_image.getbbox())
-
-            # Now, paste the image onto a blank background.
-            # (26, 26, 27) are the RGB values corresponding to
-            # hex color #1A1A1B, the comment background color.
-            background = Image.new("RGB", (2560, 1440), (26, 26, 27))
-            background.paste(comment_image, (0, (background.height - comment_image.height) // 2))
-
-            # Finally, write the final image to disk.
-            image_file = os.path.join(self.tmpdir.name, f"{self.comment.id}.{i}.png")
-            background.save(image_file)
-            image_files.append(image_file)
-
-        return image_files
-
-    def manufacture_audios(self) -> list[str]:
-        audio_files = []
-
-        # Load google text-to-speech client.
-        # We are manufacturing mp3 files.
-        client = texttospeech.TextToSpeechClient()
-        audio_config = texttospeech.AudioConfig(audio_encoding=texttospeech.AudioEncoding.MP3)
-
-        # Loop through all cuts.
-        # We are saving each audio segment individually.
-        for i, cut in enumerate(self._text_cuts):
-            # We need to escape the html as to not confuse
-            # Google Cloud's text-to-speech API.
-            ssml = html.escape(cut)
-            ssml = "<speak>" + ssml + "</speak>"
-
-            # Let's synthesize our ssml and send our request to Google!
-            synthesis_input = texttospeech.SynthesisInput(ssml=ssml)
-            response = client.synthesize_speech(
-                input=synthesis_input,
-                voice=random_voice_params(),
-                audio_config=audio_config
+            comment_htmls.append(
+                comment_html_format.format(
+                    "flex" if i == len(self._text_cuts) - 1 else "none",
+                    pfp_url,
+                    getattr(self.comment.author, "name", "anonymous"),
+                    cut,
+                    format_score(self.comment.score),
+                    vote_font=self.vote_font
+                )
             )
 
-            # Now, let's write the response bytes to disk.
-            audio_file = os.path.join(self.tmpdir.name, f"{self.comment.id}.{i}.mp3")
-            with open(audio_file, "wb") as f:
-                f.write(response.audio_content)
-            audio_files.append(audio_file)
+        # Finally, screenshot all the html in batches using our render pool.
+        # The screenshots are handed back to us in memory,
+        # already cropped down to the comment itself.
+        return self.screenshot_batch(comment_htmls)
+
+    def _reveal_images(self, pfp_url: str) -> list[Image.Image]:
+        if not self._text_cuts:
+            return []
 
-        return audio_files
+        # Render the entire comment just once, with a marker after every cut.
+        # The bottom container starts hidden for screenshot_reveal to measure.
+        comment = "".join(
+            html.escape(cut).replace("\n", "<br/>") + self.reveal_marker
+            for cut in self._text_cuts
+        )
+        comment_html = comment_html_format.format(
+            "none",
+            pfp_url,
+            getattr(self.comment.author, "name", "anonymous"),
+            markdown.markdown(comment),
+            format_score(self.comment.score),
+            vote_font=self.vote_font
+        )
+        images = self.screenshot_reveal(comment_html, ".comment", len(self._text_cuts))
+        if images is None:
+            return self._render_images(pfp_url)
+        return images
@@ -1,25 +1,65 @@
 import html
 import itertools
-import os
 
 import praw.models
 from PIL import Image
-from google.cloud import texttospeech
 
+from .AssetCache import AssetCache
 from .html_formats import title_html_format
-from ._HTIMediaFactory import _HTIMediaFactory
-from .utils import format_score, random_voice_params, text_cuts
-
-
-class _RedditTitleMediaFactory(_HTIMediaFactory):
-    def __init__(self, submission: praw.models.Submission):
+from .OutputProfile import OutputProfile, landscape
+from .RenderPool import RenderPool
+from ._SpeechMediaFactory import _SpeechMediaFactory
+from .TTSCache import TTSCache
+from .TTSClient import TTSClient
+from .utils import format_score
+
+
+class _RedditTitleMediaFactory(_SpeechMediaFactory):
+    def __init__(
+            self,
+            submission: praw.models.Submission,
+            render_pool: RenderPool = None,
+            tts_cache: TTSCache = None,
+            reveal: str = "render",
+            directory: str = None,
+            asset_cache: AssetCache = None,
+            tts_client: TTSClient = None
+    ):
         self.submission = submission
-        self._text_cuts = text_cuts(self.submission.title)
 
-        super(_RedditTitleMediaFactory, self).__init__()
-
-    def manufacture_images(self) -> list[str]:
-        image_files = []
+        super(_RedditTitleMediaFactory, self).__init__(
+            self.submission.title,
+            render_pool,
+            tts_cache,
+            reveal,
+            directory,
+            asset_cache,
+            tts_client
+        )
+
+    @property
+    def stem(self) -> str:
+        return self.submission.id
+
+    def manufacture_cards(self) -> list[Image.Image]:
+        # A card is the image of the title, with each cut and its
+        # preceding text, cropped down to the title itself.
+        # Cards stay in memory; they are not written to disk.
+        if self.reveal == "mask":
+            return self._reveal_images()
+        return self._render_images()
+
+    def manufacture_images(self, profile: OutputProfile = landscape) -> list[str]:
+        # Paste every card onto a whole frame of the profile,
+        # and write the frames to disk.
+        return self.save_images(self.manufacture_cards(), self.stem, profile)
+
+    def manufacture_card_files(self) -> list[str]:
+        # Write the cards to disk as they are, to be composited by ffmpeg.
+        return self.save_images(self.manufacture_cards(), self.stem)
+
+    def _render_images(self) -> list[Image.Image]:
+        title_htmls = []
 
         for i, cut in enumerate(itertools.accumulate(self._text_cuts)):
             # Note that there are probably various pesky
@@ -27,66 +67,43 @@ class _RedditTitleMediaFactory(_HTIMediaFactory):
             # everything hand-wavily with html.escape
             cut = html.escape(cut)
 
-            # First, format and screenshot the html using html2image.
-            # We must also write this image to disk.
             # Note the first parameter in the format call.
             # It specifies that the bottom container display only if
             # we are up to the last cut.
-            title_html = title_html_format.format(
-                "flex" if i == len(self._text_cuts) - 1 else "none",
-                format_score(self.submission.score),
-                self.submission.subreddit.icon_img,
-                self.submission.subreddit.display_name,
-                getattr(self.submission.author, "name", "anonymous"),
-                cut
+            title_htmls.append(
+                title_html_format.format(
+                    "flex" if i == len(self._text_cuts) - 1 else "none",
+                    format_score(self.submission.score),
+                    self.inline(self.submission.subreddit.icon_img),
+                    self.submission.subreddit.display_name,
+                    getattr(self.submission.author, "name", "anonymous"),
+                    cut,
+                    vote_font=self.vote_font
+                )
             )
-            self.hti.screenshot(html_str=title_html, save_as="RedditTitleMediaFactory.tmphti.png")
-
-            # Next, crop the image because html2image isn't perfect.
-            title_image = Image.open(os.path.join(self.tmpdir.name, "RedditTitleMediaFactory.tmphti.png"))
-            title_image = title_image.crop(title_image.getbbox())
-
-            # Now, paste the image onto a blank background.
-            # (26, 26, 27) are the RGB values corresponding to
-            # hex color #1A1A1B, the comment background color.
-            background = Image.new("RGB", (2560, 1440), (26, 26, 27))
-            background.paste(title_image, (0, (background.height - title_image.height) // 2))
-
-            # Finally, write the final image to disk.
-            image_file = os.path.join(self.tmpdir.name, f"{self.submission.id}.{i}.png")
-            background.save(image_file)
-            image_files.append(image_file)
-
-        return image_files
-
-    def manufacture_audios(self) -> list[str]:
-        audio_files = []
-
-        # Load google text-to-speech client.
-        # We are manufacturing mp3 files.
-        client = texttospeech.TextToSpeechClient()
-        audio_config = texttospeech.AudioConfig(audio_encoding=texttospeech.AudioEncoding.MP3)
-
-        # Loop through all cuts.
-        # We are saving each audio segment individually.
-        for i, cut in enumerate(self._text_cuts):
-            # We need to escape the html as to not confuse
-            # Google Cloud's text-to-speech API.
-            ssml = html.escape(cut)
-            ssml = "<speak>" + ssml + "</speak>"
-
-            # Let's synthesize our ssml and send our request to Google!
-            synthesis_input = texttospeech.SynthesisInput(ssml=ssml)
-            response = client.synthesize_speech(
-                input=synthesis_input,
-                voice=random_voice_params(),
-                audio_config=audio_config
-            )
-
-            # Now, let's write the response bytes to disk.
-            audio_file = os.path.join(self.tmpdir.name, f"{self.submission.id}.{i}.mp3")
-            with open(audio_file, "wb") as f:
-                f.write(response.audio_content)
-            audio_files.append(audio_file)
 
-        return audio_files
+        # Finally, screenshot all the html in batches using our render pool.
+        # The screenshots are handed back to us in memory,
+        # already cropped down to the title itself.
+        return self.screenshot_batch(title_htmls)
+
+    def _reveal_images(self) -> list[Image.Image]:
+        if not self._text_cuts:
+            return []
+
+        # Render the entire title just once, with a marker after every cut.
+        # The bottom container starts hidden for screenshot_reveal to measure.
+        title = "".join(html.escape(cut) + self.reveal_marker for cut in self._text_cuts)
+        title_html = title_html_format.format(
+            "none",
+            format_score(self.submission.score),
+            self.inline(self.submission.subreddit.icon_img),
+            self.submission.subreddit.display_name,
+            getattr(self.submission.author, "name", "anonymous"),
+            title,
+            vote_font=self.vote_font
+        )
+        images = self.screenshot_reveal(title_html, ".title", len(self._text_cuts))
+        if images is None:
+            return self._render_images()
+        return images
@@ -0,0 +1,112 @@
+import concurrent.futures
+import html
+import os
+
+from .AssetCache import AssetCache
+from ._HTIMediaFactory import _HTIMediaFactory
+from .RenderPool import RenderPool
+from .Tracer import Tracer
+from .TTSCache import TTSCache
+from .TTSClient import TTSClient
+from .utils import cut_spans, marked_ssml, media_duration, random_voice_params, text_cuts, texttospeech
+
+
+class _SpeechMediaFactory(_HTIMediaFactory):
+    # An html media factory for a piece of text that is also read aloud,
+    # i.e., a title or a comment. The text is cut up for reveal, and every
+    # cut is spoken as it appears. Subclasses name their files after stem.
+    def __init__(
+            self,
+            text: str,
+            render_pool: RenderPool = None,
+            tts_cache: TTSCache = None,
+            reveal: str = "render",
+            directory: str = None,
+            asset_cache: AssetCache = None,
+            tts_client: TTSClient = None
+    ):
+        self._text_cuts = text_cuts(text)
+        # The voice is chosen once per stem and is the same on every run,
+        # which keeps cached speech reusable.
+        self.voice = random_voice_params(self.stem)
+        self.tts_cache = tts_cache
+        # Speech is synthesized by the shared client unless told otherwise.
+        self.tts_client = tts_client if tts_client is not None else TTSClient.shared()
+        self._speech_futures = {}
+
+        super(_SpeechMediaFactory, self).__init__(render_pool, reveal, directory, asset_cache)
+
+    @property
+    def stem(self) -> str:
+        # This is the id (e.g., a comment's) that our files are named after.
+        raise NotImplementedError
+
+    def _cut_requests(self) -> list[texttospeech.SynthesizeSpeechRequest]:
+        # We are manufacturing mp3 files, one for every cut.
+        audio_config = texttospeech.AudioConfig(audio_encoding=texttospeech.AudioEncoding.MP3)
+        requests = []
+        for cut in self._text_cuts:
+            # We need to escape the html as to not confuse
+            # Google Cloud's text-to-speech API.
+            ssml = html.escape(cut)
+            ssml = "<speak>" + ssml + "</speak>"
+            requests.append(texttospeech.SynthesizeSpeechRequest(
+                input=texttospeech.SynthesisInput(ssml=ssml),
+                voice=self.voice,
+                audio_config=audio_config
+            ))
+        return requests
+
+    def _marked_request(self) -> texttospeech.SynthesizeSpeechRequest:
+        return texttospeech.SynthesizeSpeechRequest(
+            input=texttospeech.SynthesisInput(ssml=marked_ssml(self._text_cuts)),
+            voice=self.voice,
+            audio_config=texttospeech.AudioConfig(audio_encoding=texttospeech.AudioEncoding.MP3),
+            enable_time_pointing=[texttospeech.SynthesizeSpeechRequest.TimepointType.SSML_MARK]
+        )
+
+    def prefetch_speech(self, marked: bool = False):
+        # Send our requests for speech now, without waiting for them, so
+        # that they are in flight while we do other things. The next
+        # manufacture_audios (or manufacture_marked_audio, if marked)
+        # picks up their responses.
+        self._speech_futures[marked] = self._speech(marked)
+
+    def _speech(self, marked: bool) -> list[concurrent.futures.Future]:
+        futures = self._speech_futures.pop(marked, None)
+        if futures is None:
+            requests = [self._marked_request()] if marked else self._cut_requests()
+            futures = [self.tts_client.submit(request, self.tts_cache) for request in requests]
+        return futures
+
+    def manufacture_audios(self) -> list[str]:
+        audio_files = []
+
+        # Let's send all our requests to Google at once, and then save
+        # each response as it comes back. If we have synthesized an exact
+        # request before, its response comes straight from the cache instead.
+        for i, future in enumerate(self._speech(False)):
+            response = future.result()
+
+            # Now, let's write the response bytes to disk.
+            audio_file = os.path.join(self.tmpdir.name, f"{self.stem}.{i}.mp3")
+            with open(audio_file, "wb") as f:
+                f.write(response.audio_content)
+            Tracer.count("bytes written", len(response.audio_content))
+            audio_files.append(audio_file)
+
+        return audio_files
+
+    def manufacture_marked_audio(self) -> tuple[str, list[tuple[float, float]]]:
+        # Rather than synthesizing every cut on its own, let's synthesize
+        # the whole text at once with a mark between each cut.
+        # Google tells us when each mark is reached, which gives us the
+        # (offset, duration) of every cut within the single audio file.
+        response = self._speech(True)[0].result()
+
+        audio_file = os.path.join(self.tmpdir.name, f"{self.stem}.mp3")
+        with open(audio_file, "wb") as f:
+            f.write(response.audio_content)
+        Tracer.count("bytes written", len(response.audio_content))
+
+        return audio_file, cut_spans(response.timepoints, len(self._text_cuts), media_duration(audio_file))
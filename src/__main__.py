@@ -0,0 +1,157 @@
+# Make videos out of a batch of reddit submissions, e.g.:
+#   python -m src 1a2b3c https://www.reddit.com/r/AskReddit/comments/4d5e6f/ saved.json.gz
+#   python -m src --input today.txt --upload --credentials client_secret.json --storage credentials.storage
+import argparse
+import contextlib
+import json
+import os
+import sys
+
+import praw
+
+from .OutputProfile import presets
+from .RedditBatchRunner import RedditBatchRunner
+from .RedditThreadMediaFactory import RedditThreadMediaFactory
+from .Tracer import Tracer
+from .TTSCache import TTSCache
+
+
+def _print_status(statuses: list[dict]):
+    for status in statuses:
+        line = f"{status['source']}: {status['state']}"
+        progress = status["upload_progress"]
+        if status["state"] == "upload" and progress is not None:
+            fraction = progress["bytes"] / max(1, progress["size"])
+            line += f" {fraction:.0%} at {progress['bytes_per_second'] / 1e6:.1f} MB/s"
+        print(line, file=sys.stderr)
+    print(file=sys.stderr, flush=True)
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(
+        prog="python -m src",
+        description="Make videos out of reddit submissions, and optionally upload them to YouTube."
+    )
+    parser.add_argument("sources", nargs="*", help="submission ids, submission urls, or snapshot files")
+    parser.add_argument("--input", help="a file with one source per line")
+    parser.add_argument("--output-directory", default=".")
+    parser.add_argument("--praw-site", default="DEFAULT", help="the praw.ini site to log in to reddit with")
+
+    limits = parser.add_argument_group("concurrency")
+    limits.add_argument("--workers", type=int, default=4, help="stages running at once, across all jobs")
+    limits.add_argument("--unit-workers", type=int, default=1, help="comments manufactured at once, per video")
+    limits.add_argument("--browsers", type=int, default=2)
+    limits.add_argument("--tts", type=int, default=8, help="text-to-speech requests in flight at once")
+    limits.add_argument("--tts-rate", type=float, help="text-to-speech requests per second at most")
+    limits.add_argument("--ffmpeg", type=int, default=2, help="ffmpeg processes at once")
+    limits.add_argument("--uploads", type=int, default=1)
+
+    video = parser.add_argument_group("video")
+    video.add_argument("--runtime", type=float, help="the target runtime of each video in seconds")
+    video.add_argument("--fps", type=float, default=25)
+    video.add_argument("--transition", nargs=2, metavar=("VIDEO", "AUDIO"))
+    video.add_argument("--speech", choices=RedditThreadMediaFactory.speech_modes, default="cuts")
+    video.add_argument("--reveal", choices=("render", "mask"), default="render")
+    video.add_argument("--frames", choices=RedditThreadMediaFactory.frames_modes, default="png")
+    video.add_argument("--streaming", action="store_true")
+    video.add_argument(
+        "--profiles",
+        nargs="+",
+        choices=presets,
+        default=["landscape"],
+        help="the output profiles to make videos in; the first is uploaded"
+    )
+    video.add_argument("--encoding", choices=RedditThreadMediaFactory.encoding_modes, default="constant")
+    video.add_argument("--tts-cache", help="a directory to cache synthesized speech in")
+    video.add_argument("--workdir", help="a directory to keep intermediate files in, so failed jobs can resume")
+
+    upload = parser.add_argument_group("upload")
+    upload.add_argument("--upload", action="store_true")
+    upload.add_argument("--credentials", help="the YouTube client secrets file")
+    upload.add_argument("--storage", help="the YouTube credentials storage file")
+    upload.add_argument("--category", default="24", help="the YouTube category id (24 is Entertainment)")
+    upload.add_argument("--tags", nargs="*")
+    upload.add_argument("--privacy-status", default="public", choices=("public", "unlisted", "private"))
+    upload.add_argument("--chunk-mib", type=int, default=8, help="the size of each uploaded chunk in MiB")
+    upload.add_argument("--upload-retries", type=int, default=8, help="errors in a row to retry before giving up")
+
+    parser.add_argument("--status-interval", type=float, default=30, help="seconds between status updates")
+    parser.add_argument("--trace", help="save a chrome trace of the whole batch to this file")
+    parser.add_argument("--report", help="save a report of the whole batch's stages to this file")
+    args = parser.parse_args()
+
+    sources = list(args.sources)
+    if args.input is not None:
+        with open(args.input) as f:
+            sources.extend(line.strip() for line in f if line.strip() and not line.startswith("#"))
+    if not sources:
+        parser.error("no sources given")
+    if args.upload and (args.credentials is None or args.storage is None):
+        parser.error("--upload requires --credentials and --storage")
+
+    # We only log in to reddit if some source needs fetching.
+    # Let praw complain about missing credentials then.
+    reddit = None
+    if not all(map(os.path.isfile, sources)):
+        reddit = praw.Reddit(args.praw_site)
+
+    uploader_kwargs = None
+    if args.upload:
+        uploader_kwargs = dict(
+            credentials=args.credentials,
+            storage=args.storage,
+            category=args.category,
+            tags=args.tags,
+            privacy_status=args.privacy_status,
+            chunk_size=args.chunk_mib << 20,
+            retries=args.upload_retries
+        )
+
+    runner = RedditBatchRunner(
+        args.output_directory,
+        reddit,
+        workers=args.workers,
+        browsers=args.browsers,
+        tts=args.tts,
+        tts_rate=args.tts_rate,
+        ffmpeg=args.ffmpeg,
+        uploads=args.uploads,
+        tts_cache=None if args.tts_cache is None else TTSCache(args.tts_cache),
+        workdir=args.workdir,
+        runtime=args.runtime,
+        factory_kwargs=dict(
+            fps=args.fps,
+            transition=None if args.transition is None else tuple(args.transition),
+            workers=args.unit_workers,
+            speech=args.speech,
+            reveal=args.reveal,
+            frames=args.frames,
+            streaming=args.streaming,
+            encoding=args.encoding,
+            profiles=[presets[name] for name in args.profiles]
+        ),
+        uploader_kwargs=uploader_kwargs
+    )
+
+    # We only trace if asked to, since a trace grows with the batch.
+    tracing = args.trace is not None or args.report is not None
+    tracer = Tracer()
+    with runner, tracer if tracing else contextlib.nullcontext():
+        jobs = runner.run(sources, _print_status, args.status_interval)
+
+    if args.trace is not None:
+        tracer.save_chrome_trace(args.trace)
+    if args.report is not None:
+        tracer.save_report(args.report)
+
+    # The final status of every job goes to stdout as json.
+    json.dump(runner.status(), sys.stdout, indent=2)
+    print()
+    for job in jobs:
+        if job.traceback is not None:
+            print(f"{job.source} failed:\n{job.traceback}", file=sys.stderr)
+    return 1 if any(job.error is not None for job in jobs) else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
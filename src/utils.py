@@ -1,16 +1,132 @@
+import concurrent.futures
+import functools
+import html
+import json
+import os
 import random
 import re
 import typing
 
 import ffmpeg
-from google.cloud import texttospeech
+# Timepoints for ssml marks are only available in the v1beta1 API, which
+# otherwise synthesizes just like v1. Every module imports texttospeech from
+# here, so that requests, responses, and cached speech are of one version
+# whether or not we use marks.
+from google.cloud import texttospeech_v1beta1 as texttospeech
 
+from .ResourceLimits import ResourceLimits
+from .Tracer import Tracer
 
-def media_duration(file: str):
+
+# These tables describe MPEG audio layer III frame headers.
+# Bitrates are in kbps and are indexed by the header's bitrate index.
+_mp3_bitrates = {
+    1: (0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320),
+    2: (0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160),
+}
+_mp3_sample_rates = {
+    1: (44100, 48000, 32000),
+    2: (22050, 24000, 16000),
+    2.5: (11025, 12000, 8000),
+}
+
+
+def mp3_duration(data: bytes) -> typing.Optional[float]:
+    # Compute the duration of an mp3 by walking its frame headers,
+    # which is far cheaper than spawning an ffprobe process.
+    # None means that we could not make sense of the data.
+    i = 0
+
+    # Skip over an ID3v2 tag, whose size is stored as a syncsafe integer.
+    if data[:3] == b"ID3" and len(data) >= 10:
+        i = 10 + ((data[6] & 0x7F) << 21 | (data[7] & 0x7F) << 14 | (data[8] & 0x7F) << 7 | (data[9] & 0x7F))
+        if data[5] & 0x10:
+            i += 10
+
+    samples = 0
+    sample_rate = None
+    first = True
+    while i + 4 <= len(data):
+        header = int.from_bytes(data[i:i + 4], "big")
+
+        # Every frame starts with 11 set sync bits.
+        # We stop at anything else, e.g., an ID3v1 tag at the end.
+        if header >> 21 != 0x7FF:
+            break
+
+        version = {0b00: 2.5, 0b10: 2, 0b11: 1}.get(header >> 19 & 0b11)
+        layer = header >> 17 & 0b11
+        bitrate_index = header >> 12 & 0b1111
+        sample_rate_index = header >> 10 & 0b11
+        padding = header >> 9 & 0b1
+
+        # We only handle layer III with a known bitrate.
+        if version is None or layer != 0b01 or bitrate_index in (0, 15) or sample_rate_index == 3:
+            return None
+
+        bitrate = _mp3_bitrates[1 if version == 1 else 2][bitrate_index] * 1000
+        frame_sample_rate = _mp3_sample_rates[version][sample_rate_index]
+        frame_samples = 1152 if version == 1 else 576
+        frame_length = frame_samples // 8 * bitrate // frame_sample_rate + padding
+
+        if sample_rate is None:
+            sample_rate = frame_sample_rate
+        elif sample_rate != frame_sample_rate:
+            return None
+
+        # A leading Xing or Info frame holds metadata rather than audio.
+        frame = data[i:i + frame_length]
+        if not (first and (b"Xing" in frame[:64] or b"Info" in frame[:64])):
+            samples += frame_samples
+        first = False
+
+        i += frame_length
+
+    if sample_rate is None:
+        return None
+    return samples / sample_rate
+
+
+@functools.lru_cache(maxsize=4096)
+def _media_duration(file: str, mtime_ns: int, size: int) -> float:
+    # We key the memo on the modification time and size of the file
+    # as well, so that a rewritten file is measured again. The memo only
+    # keeps the most recent files, so that it stays small however many
+    # threads we make videos of.
+    if file.lower().endswith(".mp3"):
+        with open(file, "rb") as f:
+            duration = mp3_duration(f.read())
+        if duration is not None:
+            return duration
+
+    # Fall back to ffprobe for anything we cannot handle ourselves.
+    Tracer.count("ffprobe invocations")
     probe = ffmpeg.probe(file)
     return float(probe["format"]["duration"])
 
 
+def media_duration(file: str) -> float:
+    stat = os.stat(file)
+    with Tracer.span("probe"):
+        return _media_duration(os.path.abspath(file), stat.st_mtime_ns, stat.st_size)
+
+
+def media_durations(files: typing.Iterable[str], workers: int = 8) -> list[float]:
+    # Measure many files at once. mp3s are parsed in-process, which holds
+    # the GIL, so there is nothing to gain from threads. Only the files
+    # that need ffprobe are probed concurrently, and only if there are any.
+    files = list(files)
+    durations = [media_duration(file) if file.lower().endswith(".mp3") else None for file in files]
+    probed = [i for i, duration in enumerate(durations) if duration is None]
+    if len(probed) == 1:
+        durations[probed[0]] = media_duration(files[probed[0]])
+    elif probed:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=min(workers, len(probed))) as executor:
+            for i, duration in zip(probed, executor.map(media_duration, (files[i] for i in probed))):
+                durations[i] = duration
+    return durations
+
+
 def chunk(collection: typing.Collection, size: int):
     i = 0
     while i < len(collection):
@@ -25,24 +141,152 @@ def format_score(score: int) -> str:
     return scstr[:-1] + "." + scstr[-1] + "K"
 
 
-def random_voice_params() -> texttospeech.VoiceSelectionParams:
+def random_voice_params(seed: typing.Hashable = None) -> texttospeech.VoiceSelectionParams:
+    # Given a seed (e.g., a comment id), the same voice is chosen every time.
+    # This keeps the voice consistent and lets us cache synthesized speech.
+    rng = random if seed is None else random.Random(seed)
     return texttospeech.VoiceSelectionParams(
         language_code="en-US",
-        name="en-US-Standard-" + random.choice("ABCDEFGHIJ")
+        name="en-US-Standard-" + rng.choice("ABCDEFGHIJ")
     )
 
 
-def text_cuts(text) -> list[str]:
-    # These characters will be used as delimiters
-    # for naturally cutting comment text.
-    cut_delimiters = ".,:?!"
+def synthesize_speech(
+        client: texttospeech.TextToSpeechClient,
+        request: texttospeech.SynthesizeSpeechRequest,
+        cache=None
+) -> texttospeech.SynthesizeSpeechResponse:
+    if cache is None:
+        return _synthesize_speech(client, request)
+
+    # The request holds the ssml, the voice, and the audio config,
+    # which are exactly what determine the response.
+    # We serialize it as sorted json so that the key is stable.
+    key = cache.key(
+        json.dumps(texttospeech.SynthesizeSpeechRequest.to_dict(request), sort_keys=True).encode()
+    )
+    data = cache.get(key)
+    if data is not None:
+        Tracer.count("tts cache hits")
+        return texttospeech.SynthesizeSpeechResponse.deserialize(data)
+
+    response = _synthesize_speech(client, request)
+    cache.put(key, texttospeech.SynthesizeSpeechResponse.serialize(response))
+    return response
+
+
+def _synthesize_speech(
+        client: texttospeech.TextToSpeechClient,
+        request: texttospeech.SynthesizeSpeechRequest
+) -> texttospeech.SynthesizeSpeechResponse:
+    Tracer.count("tts requests")
+    Tracer.count("tts characters", len(request.input.ssml or request.input.text))
+    with ResourceLimits.slot("tts"), Tracer.span("tts"):
+        return client.synthesize_speech(request=request)
+
+
+# A cut may end wherever a run of these delimiters is followed by
+# whitespace or the end of the text. Requiring the whitespace keeps
+# numbers (3.5, 1,000), urls, and words like "wait...what" whole.
+# Closing quotes and brackets stay with the delimiters they follow.
+# Matches only start at the start of a word, so that a long word is
+# not searched again from every one of its characters.
+_cut_pattern = re.compile(r"(?<!\S)(?P<word>\S*?)(?P<delimiters>[.,:;?!\u2026]+[\"')\]\u201d\u2019]*)(?=\s|$)")
+
+# A period after one of these words or after dotted letters (e.g., U.S.
+# or a.m.) does not end a cut. Neither does a period after an initial,
+# i.e., a capital letter other than "I" followed by a capitalized word,
+# as in "J. Smith". Other single letters (e.g., "It was I." or "plan a.")
+# may well end a sentence.
+_abbreviations = frozenset((
+    "approx", "dept", "dr", "e.g", "est", "fig", "i.e", "jr", "mr", "mrs", "ms", "mt", "prof", "sr", "st", "vol", "vs"
+))
+_dotted_pattern = re.compile(r"[a-z](?:\.[a-z])+")
+_initial_pattern = re.compile(r"[A-HJ-Z]")
+_next_word_pattern = re.compile(r"\s*(\S)")
+
+# Every cut is its own reveal image and its own mark in the speech, so we
+# merge cuts that are too short to be worth a pause into the next one,
+# and split cuts that are too long to read at a glance at a space.
+min_cut_chars = 30
+max_cut_chars = 180
+
+
+def _is_abbreviation(word: str, delimiters: str, text: str, end: int) -> bool:
+    # end is where the delimiters end in text.
+    if delimiters != ".":
+        return False
+    word = word.lstrip("\"'([\u201c\u2018")
+    if _initial_pattern.fullmatch(word) is not None:
+        next_word = _next_word_pattern.match(text, end)
+        return next_word is not None and next_word[1].isupper()
+    word = word.lower()
+    return word in _abbreviations or _dotted_pattern.fullmatch(word) is not None
+
+
+def _split_long(cut: str, max_chars: int) -> typing.Iterator[str]:
+    # Split at the last space that fits, or, in a word longer than
+    # max_chars, wherever we have to. Spaces start the following cut,
+    # just like they do after a delimiter.
+    while len(cut) > max_chars:
+        i = cut.rfind(" ", 1, max_chars + 1)
+        if i <= 0:
+            i = max_chars
+        yield cut[:i]
+        cut = cut[i:]
+    if cut:
+        yield cut
+
+
+def text_cuts(text: str, min_chars: int = min_cut_chars, max_chars: int = max_cut_chars) -> list[str]:
+    # Cut the text where it naturally pauses. Joining the cuts always
+    # gives back the text, since the cuts are revealed one after another.
+    if min_chars > max_chars:
+        raise ValueError(f"min_chars must be at most max_chars, not {min_chars} > {max_chars}")
+
+    pieces = []
+    start = 0
+    for match in _cut_pattern.finditer(text):
+        if match.end() > start and not _is_abbreviation(match["word"], match["delimiters"], text, match.end()):
+            pieces.append(text[start:match.end()])
+            start = match.end()
+    if start < len(text):
+        pieces.append(text[start:])
+
+    cuts = []
+    for piece in pieces:
+        for part in _split_long(piece, max_chars):
+            # A cut too short to speak on its own absorbs the next one, if they fit together.
+            if cuts and len(cuts[-1].strip()) < min_chars and len(cuts[-1]) + len(part) <= max_chars:
+                cuts[-1] += part
+            else:
+                cuts.append(part)
+
+    # A short last cut joins the one before it instead.
+    if len(cuts) > 1 and len(cuts[-1].strip()) < min_chars and len(cuts[-2]) + len(cuts[-1]) <= max_chars:
+        last = cuts.pop()
+        cuts[-1] += last
+
+    return cuts
+
 
-    # This pattern effectively allows us to
-    # split a string by repeating delimiters.
-    cut_pattern = re.compile(rf"[^{cut_delimiters}]*[{cut_delimiters}]*")
+def marked_ssml(cuts: list[str]) -> str:
+    # Join the cuts into one ssml document with a mark after every cut
+    # but the last. Mark i then tells us where cut i ends in the audio.
+    # We need to escape the html as to not confuse
+    # Google Cloud's text-to-speech API.
+    return "<speak>" + "".join(
+        html.escape(cut) + (f'<mark name="{i}"/>' if i < len(cuts) - 1 else "")
+        for i, cut in enumerate(cuts)
+    ) + "</speak>"
 
-    # Cut the text using our regex pattern from above.
-    matches = cut_pattern.findall(text)
-    matches = list(filter(None, matches))
 
-    return matches
+def cut_spans(timepoints: typing.Iterable, ncuts: int, duration: float) -> list[tuple[float, float]]:
+    # Convert the timepoints of the marks from marked_ssml
+    # into the (offset, duration) of each cut in the audio.
+    ends = {int(timepoint.mark_name): timepoint.time_seconds for timepoint in timepoints}
+    if sorted(ends) != list(range(ncuts - 1)):
+        raise ValueError(f"expected {ncuts - 1} timepoints, but got marks {sorted(ends)}")
+    ends = [ends[i] for i in range(ncuts - 1)] + [duration]
+    starts = [0.0] + ends[:-1]
+    return [(start, end - start) for start, end in zip(starts, ends)]